@@ -0,0 +1,128 @@
+"""Time byop build and byop zip end to end against the local MOS stand-in.
+
+Each case runs the real byop CLI in a scratch directory, with mos_url pointed at
+benchmarks/mos_standin.py, and reports wall time and throughput:
+
+    python benchmarks/build_zip.py --size-mb 300 --rate 100M --latency 0.05 --fail-rate 0.1
+
+The patch files are kept in benchmarks/mos-files between runs, so only the first run
+pays for building them.
+"""
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+import mos_standin
+
+
+def byop(work, *args):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(ROOT) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', 'import byop; byop.cli()'] + list(args), cwd=work, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.stderr.write(result.stdout)
+        raise SystemExit('byop ' + ' '.join(args) + ' failed with exit code ' + str(result.returncode))
+    return elapsed
+
+
+def workspace(work, src_yaml, server, a):
+    shutil.copytree(os.path.join(ROOT, 'codes'), os.path.join(work, 'codes'))
+    shutil.copy(src_yaml, os.path.join(work, 'byop.yaml'))
+    byop(work, 'config', '--mos-username', 'bench@example.com', '--mos-password', server.password)
+    with open(os.path.join(work, 'config.json')) as f:
+        config = json.load(f)
+    config.update({'mos_url': server.base,
+                   'download_threads': a.threads,
+                   'download_segments': a.segments,
+                   'zip_volumes': a.volumes})
+    with open(os.path.join(work, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def reset(work):
+    for name in ('output', 'tmp'):
+        shutil.rmtree(os.path.join(work, name), ignore_errors=True)
+
+
+def size_of(pattern):
+    return sum(os.path.getsize(path) for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--yaml', default=os.path.join(ROOT, 'examples', 'linux.yaml.example'), help='byop input YAML')
+    p.add_argument('--files', default=os.path.join(HERE, 'mos-files'), help='where the stand-in keeps its patch files')
+    p.add_argument('--size-mb', type=int, default=300, help='size of each patch file')
+    p.add_argument('--rate', type=mos_standin.parse_size, default=0, help='stand-in bandwidth cap, e.g. 100M')
+    p.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    p.add_argument('--fail-rate', type=float, default=0, help='share of downloads that drop part way')
+    p.add_argument('--threads', type=int, default=2, help='download_threads')
+    p.add_argument('--segments', type=int, default=4, help='download_segments')
+    p.add_argument('--volumes', type=int, default=2, help='zip_volumes')
+    p.add_argument('--runs', type=int, default=1, help='repeat each case and keep the fastest')
+    a = p.parse_args()
+
+    catalog = mos_standin.Catalog(a.files, a.yaml, os.path.join(ROOT, 'codes', 'codes.yaml'), a.size_mb << 20)
+    server = mos_standin.StandinServer(catalog, rate=a.rate, latency=a.latency, fail_rate=a.fail_rate).start()
+    work = tempfile.mkdtemp(prefix='byop-bench-')
+    try:
+        workspace(work, a.yaml, server, a)
+        archives = os.path.join(work, 'output', 'cpu_archives', '**')
+        zips = os.path.join(work, 'output', 'PT-INFRA*.zip')
+
+        def cold_build():
+            reset(work)
+            return byop(work, 'build', '--quiet')
+
+        def warm_build():
+            return byop(work, 'build', '--quiet')
+
+        def zip_only():
+            for path in glob.glob(zips):
+                os.remove(path)
+            return byop(work, 'zip', '--quiet')
+
+        def build_and_zip():
+            reset(work)
+            return byop(work, 'build', '--zip', '--quiet')
+
+        # name, case, what the MB/s is measured against
+        cases = [('build (cold)', cold_build, 'download'),
+                 ('build (nothing to do)', warm_build, 'download'),
+                 ('zip', zip_only, 'archives'),
+                 ('build --zip (cold)', build_and_zip, 'download')]
+
+        print('stand-in: %d patches, %d MB each, rate %s, latency %.3fs, fail rate %.2f' %
+              (len(catalog.entries), a.size_mb, '%.1f MB/s' % (a.rate / 1e6) if a.rate else 'unlimited', a.latency, a.fail_rate))
+        print('%-24s %8s %10s %10s %8s' % ('case', 'seconds', 'MB', 'MB/s', 'logins'))
+        for name, case, measure in cases:
+            best = None
+            for _ in range(a.runs):
+                before = dict(server.stats)
+                elapsed = case()
+                if best is None or elapsed < best[0]:
+                    downloaded = server.stats['bytes'] - before['bytes']
+                    logins = server.stats['logins'] - before['logins']
+                    best = (elapsed, downloaded if measure == 'download' else size_of(archives), logins)
+            elapsed, amount, logins = best
+            print('%-24s %8.2f %10.1f %10.1f %8d' % (name, elapsed, amount / 1e6, amount / 1e6 / elapsed, logins))
+        print('archives: %.1f MB in %d zip files, %d dropped connections' %
+              (size_of(zips) / 1e6, len(glob.glob(zips)), server.stats['dropped']))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
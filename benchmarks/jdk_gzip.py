@@ -0,0 +1,80 @@
+"""Compare the single-threaded tarfile gzip with byop's ParallelGzipWriter.
+
+Point it at an unpacked JDK (or any large tree) or a delivered jdk-*.tar.gz:
+
+    python benchmarks/jdk_gzip.py /usr/lib/jvm/jdk-11.0.17 --threads 8 --level 6
+"""
+import os
+import sys
+import time
+import gzip
+import shutil
+import tarfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import byop
+
+
+def build_tar(source, work):
+    # one uncompressed tar of the tree, so both writers compress identical input
+    if os.path.isfile(source):
+        tar = os.path.join(work, 'jdk.tar')
+        with gzip.open(source, 'rb') as src, open(tar, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        return tar
+    tar = os.path.join(work, 'jdk.tar')
+    with tarfile.open(tar, 'w') as t:
+        t.add(source, arcname='.')
+    return tar
+
+
+def single(tar, out, level, threads):
+    with tarfile.open(tar) as src, tarfile.open(out, 'w:gz', compresslevel=level) as dst:
+        for member in src:
+            dst.addfile(member, src.extractfile(member) if member.isreg() else None)
+
+
+def parallel(tar, out, level, threads):
+    with tarfile.open(tar) as src, open(out, 'wb') as f, \
+            byop.ParallelGzipWriter(f, level, threads) as gz, tarfile.open(fileobj=gz, mode='w') as dst:
+        for member in src:
+            dst.addfile(member, src.extractfile(member) if member.isreg() else None)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('source', help='JDK directory or jdk-*.tar.gz')
+    p.add_argument('--level', type=int, default=6)
+    p.add_argument('--threads', type=int, default=os.cpu_count())
+    p.add_argument('--runs', type=int, default=3)
+    a = p.parse_args()
+
+    work = tempfile.mkdtemp(prefix='byop-gzip-')
+    try:
+        tar = build_tar(a.source, work)
+        raw = os.path.getsize(tar)
+        print('input: %s (%.1f MB tar)' % (a.source, raw / 1e6))
+        print('%-28s %8s %10s %8s' % ('writer', 'seconds', 'MB/s', 'ratio'))
+        cases = [('tarfile w:gz level 9 (old)', single, 9, 1),
+                 ('tarfile w:gz level %d' % a.level, single, a.level, 1),
+                 ('parallel level %d x%d' % (a.level, a.threads), parallel, a.level, a.threads)]
+        for name, writer, level, threads in cases:
+            out = os.path.join(work, 'out.tgz')
+            best = None
+            for _ in range(a.runs):
+                start = time.perf_counter()
+                writer(tar, out, level, threads)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            # the result has to read back as the same tar
+            with tarfile.open(tar) as src, tarfile.open(out) as check:
+                assert src.getnames() == check.getnames()
+            print('%-28s %8.2f %10.1f %8.3f' % (name, best, raw / 1e6 / best, os.path.getsize(out) / float(raw)))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""A local stand-in for updates.oracle.com, for benchmarking byop offline.
+
+It serves the parts of MOS that byop uses: the download page redirect, the Basic Auth
+login, SimpleSearch results with ViewDigest links, and process_form downloads with Range
+support. Patch files are synthetic zips built from the patches in a byop input YAML.
+Latency, a bandwidth cap and dropped connections can be added to see how byop copes.
+
+    python benchmarks/mos_standin.py --yaml byop.yaml --size-mb 300 --rate 50M --port 8765
+
+Then set "mos_url": "http://127.0.0.1:8765" in config.json. The password is "standin"
+unless --password is given.
+"""
+import os
+import re
+import io
+import sys
+import time
+import yaml
+import base64
+import random
+import hashlib
+import tarfile
+import zipfile
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COOKIE_NAME = 'ORA_UCM_INFO'
+SECTIONS = ['weblogic', 'weblogic_opatch', 'tuxedo', 'oracleclient', 'oracleclient_opatch', 'jdk']
+
+
+def parse_size(value):
+    # 300M, 2G, 65536 - the same suffixes as byop --max-rate
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError('not a size: ' + str(value))
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' '))
+
+
+def write_blob(f, size, seed):
+    # a random 1 MB block, repeated - cheap to make, and not something zip can shrink
+    block = random.Random(seed).getrandbits(8 << 20).to_bytes(1 << 20, 'little')
+    while size > 0:
+        f.write(block[:size])
+        size -= len(block)
+
+
+def make_patch_zip(path, name, size, seed):
+    with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_STORED) as z:
+        info = zipfile.ZipInfo(name[:-4] + '/payload.bin', (2022, 10, 18, 0, 0, 0))
+        with z.open(info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as f:
+            write_blob(f, size, seed)
+    os.replace(path + '.tmp', path)
+
+
+def make_jdk_zip(path, version, platform, seed):
+    # the JDK patch is a zip holding the real bundle, a tarball on Linux and a zip on Windows
+    top = 'jdk-' + version
+    rnd = random.Random(seed)
+    bundle = io.BytesIO()
+    files = [(top + '/' + folder + '/f' + str(i), rnd.getrandbits(8 << 16).to_bytes(1 << 16, 'little'))
+             for folder in ('bin', 'lib', 'conf') for i in range(20)]
+    if platform == 'windows':
+        inner = 'jdk-' + version + '_windows-x64_bin.zip'
+        with zipfile.ZipFile(bundle, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in files:
+                z.writestr(name + '.dll', data)
+    else:
+        inner = 'jdk-' + version + '_linux-x64_bin.tar.gz'
+        with tarfile.open(fileobj=bundle, mode='w:gz') as t:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o755
+                t.addfile(info, io.BytesIO(data))
+            info = tarfile.TarInfo(top + '/bin/java')
+            info.type = tarfile.SYMTYPE
+            info.linkname = 'f0'
+            t.addfile(info)
+    with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_STORED) as z:
+        z.writestr(inner, bundle.getvalue())
+        z.writestr('readme.txt', 'jdk ' + version)
+    os.replace(path + '.tmp', path)
+
+
+class Catalog(object):
+    # The patch files for one byop input YAML, built once and kept in root
+
+    def __init__(self, root, src_yaml, codes_yaml, size):
+        self.root = root
+        self.entries = {}
+        os.makedirs(root, exist_ok=True)
+        with open(codes_yaml) as f:
+            codes = yaml.safe_load(f)
+        with open(src_yaml) as f:
+            plan = yaml.safe_load(f)
+        releases = codes['peopletools'][str(plan['peopletools'])]
+        plat = codes['platform'][plan['platform']]
+        for section in SECTIONS:
+            for patch in plan.get(section) or []:
+                number, _, version = str(patch).partition(':')
+                release = version if section == 'jdk' else releases[section]
+                simple = release.replace('.', '')
+                names = ['p' + number + '_' + simple + '_' + plat + '.zip']
+                if section == 'oracleclient':
+                    # some patches come in more than one file
+                    names.append('p' + number + '_' + simple + '_' + plat + '_2of2.zip')
+                for index, name in enumerate(names):
+                    path = os.path.join(root, name)
+                    if os.path.exists(path):
+                        continue
+                    if section == 'jdk':
+                        make_jdk_zip(path, version, plan['platform'], name)
+                    else:
+                        make_patch_zip(path, name, size, name + str(index))
+                self.entries[(number, plat)] = [(name, simple) for name in names]
+
+    def digests(self, name):
+        path = os.path.join(self.root, name)
+        sha256, md5 = hashlib.sha256(), hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+                md5.update(chunk)
+        return sha256.hexdigest(), md5.hexdigest()
+
+
+class Throttle(object):
+    # A bandwidth cap shared by every download, like a slow link to MOS
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + amount / float(self.rate)
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            sys.stderr.write('[mos] ' + (fmt % args) + '\n')
+
+    def send(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def signed_in(self):
+        return (COOKIE_NAME + '=' + self.server.session) in (self.headers.get('Cookie') or '')
+
+    def login_redirect(self):
+        return self.send(302, headers={'Location': self.server.base + '/login?request_id=' + str(self.server.stats['requests'])})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if url.path != '/login':
+            return self.send(404)
+        auth = self.headers.get('Authorization') or ''
+        if auth.startswith('Basic '):
+            user, _, password = base64.b64decode(auth[6:]).decode().partition(':')
+            if password == self.server.password:
+                self.server.count('logins')
+                return self.send(200, b'signed in', {'Set-Cookie': COOKIE_NAME + '=' + self.server.session + '; Path=/'})
+        return self.send(401, b'denied')
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.server.count('requests')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        base = self.server.base
+
+        if url.path == '/Orion/Services/download':
+            return self.send(200, b'download service') if self.signed_in() else self.login_redirect()
+
+        if url.path == '/Orion/SimpleSearch/process_form':
+            if not self.signed_in():
+                return self.login_redirect()
+            self.server.count('searches')
+            patch = query.get('patch_number', [''])[0]
+            plat = query.get('plat_lang', [''])[0]
+            lines = ['<html><body><table>']
+            for name, simple in self.server.catalog.entries.get((patch, plat), []):
+                lines.append('<tr><td><a href="' + base + '/Orion/Download/process_form/' + name + '?aru=1&file_id=1&release=' +
+                             simple + '&plat_lang=' + plat + '&patch_file=' + name + '">Download</a></td>')
+                lines.append('<td><a href="' + base + '/Orion/ViewDigest/get_form_digest?patch_file=' + name + '">Digest</a></td></tr>')
+            lines.append('</table></body></html>')
+            return self.send(200, '\n'.join(lines).encode(), {'Content-Type': 'text/html'})
+
+        if url.path == '/Orion/ViewDigest/get_form_digest':
+            name = query.get('patch_file', [''])[0]
+            if not os.path.exists(os.path.join(self.server.catalog.root, name)):
+                return self.send(404)
+            sha256, md5 = self.server.catalog.digests(name)
+            body = ('<html><table><tr><td>' + name + '</td></tr>'
+                    '<tr><td>SHA-256</td><td>' + sha256.upper() + '</td></tr>'
+                    '<tr><td>MD5</td><td>' + md5.upper() + '</td></tr></table></html>')
+            return self.send(200, body.encode(), {'Content-Type': 'text/html'})
+
+        if url.path.startswith('/Orion/Download/process_form/'):
+            if not self.signed_in():
+                return self.login_redirect()
+            # MOS hands the download off to a signed URL on another path
+            return self.send(302, headers={'Location': base + '/files/' + url.path.rsplit('/', 1)[1] + '?token=' + self.server.session})
+
+        if url.path.startswith('/files/'):
+            return self.serve_file(url.path.rsplit('/', 1)[1])
+
+        return self.send(404)
+
+    def serve_file(self, name):
+        path = os.path.join(self.server.catalog.root, name)
+        if '/' in name or not os.path.exists(path):
+            return self.send(404)
+        size = os.path.getsize(path)
+        etag = '"' + hashlib.md5((name + str(os.path.getmtime(path))).encode()).hexdigest() + '"'
+        start, end, code = 0, size - 1, 200
+        requested = self.headers.get('Range')
+        if requested and self.server.ranges and self.headers.get('If-Range', etag) == etag:
+            match = re.match(r'bytes=(\d+)-(\d*)', requested)
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            code = 206
+
+        self.send_response(code)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if code == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        self.server.count('transfers')
+        drop_at = None
+        if self.server.fail_rate and random.random() < self.server.fail_rate:
+            drop_at = random.randint(0, end - start)
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(1 << 16, left))
+                self.server.throttle.wait(len(chunk))
+                if drop_at is not None and sent + len(chunk) > drop_at:
+                    # cut the connection part way, as a flaky link would
+                    self.close_connection = True
+                    self.wfile.write(chunk[:drop_at - sent])
+                    self.server.count('bytes', drop_at - sent)
+                    self.wfile.flush()
+                    self.connection.shutdown(2)
+                    self.server.count('dropped')
+                    return
+                self.wfile.write(chunk)
+                self.server.count('bytes', len(chunk))
+                sent += len(chunk)
+                left -= len(chunk)
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, port=0, rate=0, latency=0.0, fail_rate=0.0, ranges=True, password='standin', verbose=False):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.catalog = catalog
+        self.base = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.throttle = Throttle(rate)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.ranges = ranges
+        self.password = password
+        self.verbose = verbose
+        self.session = hashlib.md5(str(random.random()).encode()).hexdigest()
+        self.stats = {'requests': 0, 'logins': 0, 'searches': 0, 'transfers': 0, 'dropped': 0, 'bytes': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def handle_error(self, request, client_address):
+        # byop closes a download early when it only needs the headers or one range
+        if not isinstance(sys.exc_info()[1], (ConnectionError, OSError)):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='mos-standin', daemon=True)
+        thread.start()
+        return self
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--yaml', required=True, help='byop input YAML with the patches to serve')
+    p.add_argument('--codes', default=os.path.join(HERE, '..', 'codes', 'codes.yaml'))
+    p.add_argument('--root', default=os.path.join(HERE, 'mos-files'), help='where the patch files are built')
+    p.add_argument('--size-mb', type=int, default=300, help='size of each patch file')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--rate', type=parse_size, default=0, help='bandwidth cap for all downloads, e.g. 50M')
+    p.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    p.add_argument('--fail-rate', type=float, default=0, help='share of downloads that drop part way')
+    p.add_argument('--no-ranges', action='store_true', help="don't support Range requests")
+    p.add_argument('--password', default='standin')
+    p.add_argument('--verbose', action='store_true')
+    a = p.parse_args()
+
+    catalog = Catalog(a.root, a.yaml, a.codes, a.size_mb << 20)
+    server = StandinServer(catalog, a.port, a.rate, a.latency, a.fail_rate, not a.no_ranges, a.password, a.verbose)
+    print('MOS stand-in at ' + server.base + ' serving ' + str(len(catalog.entries)) + ' patches from ' + a.root, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,20 @@ import os
 import py
 import re
 import sys
+import time
 import json
+import pstats
+import cProfile
+import functools
+import tracemalloc
+import zlib
+import struct
+import queue
+import itertools
+import contextlib
+import collections
 import yaml
+import hashlib
 import glob
 import logging
 import datetime
@@ -11,9 +23,14 @@ import click
 import shutil
 import requests
 import tarfile
+import tempfile
 import zipfile
+import threading
+import signal
 import cryptocode
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
 # Config Object
 class Config(dict):
@@ -33,6 +50,280 @@ class Config(dict):
         with self.config.open('w') as f:
             f.write(json.dumps(self, indent=2))
 
+# A byte range request the server would not honour
+class RangeError(IOError):
+    pass
+
+# pigz-style gzip writer - blocks are deflated on a thread pool, each primed with the last 32K
+# of the block before it, and joined with sync flushes into one standard gzip member
+class ParallelGzipWriter(object):
+    BLOCK_SIZE = 128 * 1024
+    DICT_SIZE = 32 * 1024
+
+    def __init__(self, fileobj, level=6, threads=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(int(threads or os.cpu_count() or 1), 1)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='gzip')
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.previous = b''
+        self.crc = 0
+        self.size = 0
+        # magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self.fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), 0, 255))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            block = bytes(self.buffer[:self.BLOCK_SIZE])
+            del self.buffer[:self.BLOCK_SIZE]
+            self.__submit(block, False)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if not self.pool:
+            return
+        try:
+            self.__submit(bytes(self.buffer), True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            # the output is incomplete either way - don't finish the stream
+            self.pool.shutdown()
+            self.pool = None
+        else:
+            self.close()
+
+    def __submit(self, block, last):
+        self.pending.append(self.pool.submit(self.__deflate, block, self.previous, last))
+        self.previous = block[-self.DICT_SIZE:]
+        # keep a couple of blocks in flight per thread so memory stays flat
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def __deflate(self, block, zdict, last):
+        if zdict:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+# A zip volume being written. A new volume goes to a temporary file next to it that only replaces
+# the old volume when it is closed cleanly; a volume that was cut back is appended to in place
+class ZipVolume(zipfile.ZipFile):
+    def __init__(self, zip_path, append=False):
+        self.volume_path = zip_path
+        self.tmp_path = None if append else zip_path + '.tmp'
+        self.finished = True
+        super(ZipVolume, self).__init__(self.tmp_path or zip_path, 'a' if append else 'w')
+        self.finished = False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.discard()
+        else:
+            self.close()
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            super(ZipVolume, self).close()
+        except BaseException:
+            self.__remove_tmp()
+            raise
+        if self.tmp_path:
+            os.replace(self.tmp_path, self.volume_path)
+
+    def discard(self):
+        # after a failed write - the old volume stays as it was. Members appended in place are
+        # kept (the central directory is still written), and the next refresh checks them again
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            super(ZipVolume, self).close()
+        finally:
+            self.__remove_tmp()
+
+    def __remove_tmp(self):
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+# SHA-256 and MD5 of a download, fed in file order while its ranges arrive. Only the range at the
+# frontier is hashed straight from the network; the other ranges, and whatever a resumed download
+# already had, are read back from disk (usually the page cache) once the gap before them fills.
+class StreamDigest(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.offset = 0
+
+    def update(self, start, data, segments):
+        with self.lock:
+            if start == self.offset:
+                self.sha256.update(data)
+                self.md5.update(data)
+                self.offset += len(data)
+            self.__catch_up(segments)
+
+    def hexdigests(self, segments):
+        with self.lock:
+            self.__catch_up(segments)
+            return {'sha256': self.sha256.hexdigest(), 'md5': self.md5.hexdigest()}
+
+    def __catch_up(self, segments):
+        # contiguous bytes on disk: walk the ranges in order until one is still incomplete
+        limit = self.offset
+        for start, end, written in sorted(segments):
+            if start > limit:
+                break
+            limit = max(limit, start + written)
+            if end < 0 or written < end - start + 1:
+                break
+        if limit <= self.offset:
+            return
+        start = self.offset
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while self.offset < limit:
+                data = f.read(min(DOWNLOAD_CHUNK_SIZE, limit - self.offset))
+                if not data:
+                    break
+                self.sha256.update(data)
+                self.md5.update(data)
+                self.offset += len(data)
+        count('digest_reread_bytes', self.offset - start)
+
+# Token bucket shared by every download stream - callers sleep off any debt, so going over the limit slows down instead of failing
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(self.rate, DOWNLOAD_CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+# A timed piece of work for --trace. Spans nest: build -> section -> patch -> search/download/convert/move
+class Span(object):
+    __slots__ = ('id', 'name', 'category', 'parent', 'start', 'end', 'thread', 'bytes')
+
+    def __init__(self, name, category, parent):
+        self.id = next(this.span_ids)
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end = None
+        self.thread = threading.current_thread()
+        self.bytes = 0
+
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+# HTTP adapter that counts connections opened versus requests sent
+class MOSAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        # (connect, read) seconds for every request that doesn't set its own
+        self.timeout = kwargs.pop('timeout', None)
+        self.lock = threading.Lock()
+        self.requests_sent = 0
+        self.connections_opened = 0
+        super(MOSAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(MOSAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self.__counting_pool(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def __counting_pool(self, pool_class):
+        adapter = self
+        class CountingPool(pool_class):
+            def _new_conn(self):
+                with adapter.lock:
+                    adapter.connections_opened += 1
+                return super(CountingPool, self)._new_conn()
+        return CountingPool
+
+    def send(self, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        with self.lock:
+            self.requests_sent += 1
+        return super(MOSAdapter, self).send(*args, **kwargs)
+
+# Build Plan - the validated input YAML, parsed once per command
+class BuildPlan(object):
+    __slots__ = ('src_yaml', 'platform', 'platform_code', 'platform_short', 'ptversion', 'tools_version', 'sections', 'manifest')
+
+    def __init__(self, src_yaml, platform, platform_code, ptversion, sections, manifest):
+        self.src_yaml = src_yaml
+        self.platform = platform
+        self.platform_code = platform_code
+        self.platform_short = PLATFORM_SHORT.get(platform)
+        self.ptversion = ptversion
+        self.tools_version = re.sub(r"(\d{1})\.?(\d{2})", "\\1.\\2", ptversion)
+        self.sections = sections
+        self.manifest = manifest
+
+    def section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def __repr__(self):
+        return "PeopleTools " + self.tools_version + " " + self.platform + " (" + self.platform_code + "): " + \
+            ", ".join(section.name + " " + str(len(section.patches)) for section in self.sections)
+
+class PlanSection(object):
+    __slots__ = ('name', 'product', 'release', 'patches')
+
+    def __init__(self, name, product, release, patches):
+        self.name = name
+        self.product = product
+        self.release = release
+        self.patches = patches
+
+class PlanPatch(object):
+    __slots__ = ('index', 'number', 'version', 'release')
+
+    def __init__(self, index, number, version, release):
+        self.index = index
+        self.number = number
+        self.version = version
+        self.release = release
+
 # Common Command ptions
 def verbose_option(f):
     def callback(ctx, param, value):
@@ -56,9 +347,38 @@ def quiet_option(f):
                         help="Don't print timing output",
                         callback=callback)(f)
 
+def trace_option(f):
+    return click.option('--trace',
+                        type=click.Path(dir_okay=False, writable=True),
+                        help="Write a JSON trace of where the time went (also loads in chrome://tracing or Perfetto)")(f)
+
+def metrics_option(f):
+    return click.option('--metrics',
+                        type=click.Path(dir_okay=False, writable=True),
+                        help="Write build metrics to an OpenMetrics (Prometheus) text file")(f)
+
+def profile_option(f):
+    # The profiler has to wrap the whole command, so these options never reach the command itself
+    @functools.wraps(f)
+    def command(*args, **kwargs):
+        profile = kwargs.pop('profile')
+        profile_memory = kwargs.pop('profile_memory')
+        if not profile:
+            return f(*args, **kwargs)
+        return run_profiled(profile, profile_memory, f, args, kwargs)
+    command = click.option('--profile-memory',
+                           is_flag=True,
+                           help="With --profile, also track memory and save a snapshot at the peak")(command)
+    return click.option('--profile',
+                        type=click.Path(dir_okay=False, writable=True),
+                        help="Profile the command and save the stats to this .pstats file")(command)
+
 def common_options(f):
     f = verbose_option(f)
     f = quiet_option(f)
+    f = trace_option(f)
+    f = metrics_option(f)
+    f = profile_option(f)
     return f
 
 # Initialization
@@ -66,7 +386,39 @@ pass_config = click.make_pass_decorator(Config, ensure=True)
 this = sys.modules[__name__]
 this.config = None
 this.timings = None
-this.codes = {}
+this.status_lock = threading.Lock()
+this.yaml_lock = threading.Lock()
+this.jdk_lock = threading.Lock()
+this.part_lock = threading.Lock()
+this.open_parts = {}
+this.session = None
+this.auth_lock = threading.Lock()
+this.auth_generation = 0
+this.search_lock = threading.Lock()
+this.search_cache = None
+this.resolved_searches = {}
+this.store_lock = threading.Lock()
+this.patch_status = None
+this.target_yaml = None
+this.status_dirty = False
+this.digest_lock = threading.Lock()
+this.cpu_pool = None
+this.rate_limiter = None
+this.packager = None
+this.mos_digests = {}
+this.file_digests = {}
+this.span_lock = threading.Lock()
+this.span_ids = itertools.count(1)
+this.span_stack = threading.local()
+this.spans = []
+this.root_span = None
+this.timing_spans = {}
+this.counter_lock = threading.Lock()
+this.counters = collections.Counter()
+this.patch_spans = []
+this.archives = []
+this.profile_lock = threading.Lock()
+this.profilers = []
 
 # Constants
 PEOPLETOOLS = "peopletools"
@@ -90,7 +442,35 @@ ARCHIVE = 'archive_dir'
 TEMP = 'tmp_dir'
 STATUS = 'patch_status_file'
 OUTPUT = 'zip_dir'
+STORE = 'patch_store'
 MANIFEST = 'ptinfra-manifest'
+CODES = 'codes_yaml'
+MOS_URL = 'mos_url'
+CACHE = 'cache_dir'
+DEFAULT_MOS_URL = 'https://updates.oracle.com'
+PLATFORM_SHORT = {'linux': 'LNX', 'windows': 'WIN'}
+# Input sections: (section, cpu_archives folder, patch needs a ':version')
+SECTIONS = [
+    (WEBLOGIC, WEBLOGIC_PATCHES, False),
+    (WEBLOGIC_OPATCH, WEBLOGIC_OPATCH_PATCHES, False),
+    (TUXEDO, TUXEDO_PATCHES, True),
+    (ORACLECLIENT, ORACLECLIENT_PATCHES, False),
+    (ORACLECLIENT_OPATCH, ORACLECLIENT_OPATCH_PATCHES, False),
+    (JDK, JDK_PATCHES, True),
+]
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PART_SAVE_SIZE = 8 * 1024 * 1024
+PART_SAVE_SECONDS = 2
+SEARCH_CACHE = 'mos-search.cache'
+SEARCH_CACHE_TTL = 24 * 60 * 60
+SEARCH_CACHE_VERSION = 2
+STORE_INDEX = 'index.json'
+FICLONE = 0x40049409
+STATUS_VERSION = 2
+PACKAGER_QUEUE_SIZE = 16
+PROFILE_MEMORY_INTERVAL = 0.5
+PLAN_THREADS = 8
+THROUGHPUT_MIN_BYTES = 16 * 1024 * 1024
 
 # ###### #
 # cli    #
@@ -118,6 +498,10 @@ def cli(config):
         this.config[STATUS] = os.path.join(this.config[TEMP], STATUS)
     if not config.get(MANIFEST):
         this.config[MANIFEST] = os.path.join(config.get(OUTPUT), MANIFEST)
+    if config.get(STORE):
+        this.config[STORE] = os.path.abspath(os.path.expanduser(config.get(STORE)))
+    # MOS can be pointed at a mirror or the stand-in server in benchmarks/
+    this.config[MOS_URL] = (config.get(MOS_URL) or DEFAULT_MOS_URL).rstrip('/')
 
     pass
 
@@ -173,11 +557,12 @@ def config(config, mos_username, mos_password):
               help="Only delete PT-INFRA zip file")
 @pass_config
 @common_options
-def cleanup(config, tmp, only_tmp, yaml, tgt_yaml, zip, zip_dir, only_zip, verbose, quiet):
+def cleanup(config, tmp, only_tmp, yaml, tgt_yaml, zip, zip_dir, only_zip, verbose, quiet, trace, metrics):
     """Remove files from the tmp and cpu_archives directories and remove PT-INFRA zip files."""
     this.config['verbose'] = verbose
     this.config['quiet'] = quiet
     setup_logging()
+    init_timings()
 
     if not only_zip and not only_tmp:
         # cpu_archives
@@ -219,7 +604,7 @@ def cleanup(config, tmp, only_tmp, yaml, tgt_yaml, zip, zip_dir, only_zip, verbo
     if zip or only_zip:
         if not zip_dir:
             zip_dir = this.config[OUTPUT]
-        files = glob.glob(os.path.join(zip_dir, "PT-INFRA*.zip"))
+        files = glob.glob(os.path.join(zip_dir, "PT-INFRA*.zip")) + glob.glob(os.path.join(zip_dir, "PT-INFRA*.sha256"))
         logging.debug("Zip files to remove: " + str(files))
         if files:
             for file in files:
@@ -231,6 +616,9 @@ def cleanup(config, tmp, only_tmp, yaml, tgt_yaml, zip, zip_dir, only_zip, verbo
         else:
             logging.info("No PT-INFRA zip to cleanup")
 
+    write_trace(trace)
+    write_metrics(metrics)
+
 # ##### #
 # build #
 # ##### #
@@ -247,9 +635,36 @@ def cleanup(config, tmp, only_tmp, yaml, tgt_yaml, zip, zip_dir, only_zip, verbo
               default=False,
               is_flag=True,
               help="Ignore patch status - force all patches to be redownloaded.")
+@click.option('--zip', 'zip_files',
+              is_flag=True,
+              help="Create the PT-INFRA zip files while patches download")
+@click.option('--zip-dir',
+              help="Output directory for PT-INFRA zip file" )
+@click.option('--volumes',
+              type=click.IntRange(1),
+              help="Number of PT-INFRA zip files to split the patches across. Default is 2.")
+@click.option('--max-rate',
+              help="Limit the combined download speed, in bytes per second (e.g. 50M)")
+@click.option('--max-host-connections',
+              type=click.IntRange(1),
+              help="Limit the number of open connections to each MOS host")
+@click.option('--refresh-search',
+              default=False,
+              is_flag=True,
+              help="Ignore cached MOS search results - search MOS for every patch.")
+@click.option('--platform', 'platforms',
+              multiple=True,
+              help="Build for this platform instead of the one in the input YAML. Repeat it (or separate with commas) to build several.")
+@click.option('--peopletools', 'ptversions',
+              multiple=True,
+              help="Build for this PeopleTools version instead of the one in the input YAML. Repeat it (or separate with commas) to build several.")
+@click.option('--processes',
+              type=click.IntRange(1),
+              help="Number of targets to build at once when building several. Default is all of them.")
 @common_options
 @pass_config
-def build(config, src_yaml, tgt_yaml, redownload, verbose, quiet):
+def build(config, src_yaml, tgt_yaml, redownload, zip_files, zip_dir, volumes, max_rate, max_host_connections, refresh_search,
+          platforms, ptversions, processes, verbose, quiet, trace, metrics):
     """Download and create an Infra-DPK package"""
 
     this.config['verbose'] = verbose
@@ -257,25 +672,46 @@ def build(config, src_yaml, tgt_yaml, redownload, verbose, quiet):
     setup_logging()
     
     this.config['redownload'] = redownload
+    this.config['refresh_search'] = refresh_search
     if not config.get('download_threads'):
         this.config['download_threads'] = 2
-    this.config['src_yaml'] = src_yaml
+    if not config.get('download_segments'):
+        this.config['download_segments'] = 4
+    if not config.get('segment_min_size'):
+        this.config['segment_min_size'] = 32 * 1024 * 1024
+    if config.get('download_retries') is None:
+        this.config['download_retries'] = 3
+    if config.get('gzip_level') is None:
+        this.config['gzip_level'] = 6
+    if not config.get('gzip_threads'):
+        this.config['gzip_threads'] = os.cpu_count() or 1
+    if not config.get('cpu_threads'):
+        this.config['cpu_threads'] = 2
+    if volumes:
+        this.config['zip_volumes'] = volumes
+    if max_rate:
+        this.config['max_rate'] = max_rate
+    if max_host_connections:
+        this.config['max_host_connections'] = max_host_connections
+    __set_rate_limit(this.config.get('max_rate'))
     this.config['tgt_yaml'] = os.path.join(this.config[OUTPUT], tgt_yaml)
-    logging.debug("Source YAML: " + this.config['tgt_yaml'])
+    logging.debug("Source YAML: " + src_yaml)
     logging.debug("Target YAML: " + this.config['tgt_yaml'])
     logging.debug(this.config['mos_username'])
 
-    if not os.path.exists(src_yaml):
-        logging.info("Source YAML File not found: " + src_yaml)
-        exit(2)
+    targets = __build_targets(platforms, ptversions)
+    if len(targets) > 1:
+        build_matrix(src_yaml, targets, tgt_yaml, zip_files, zip_dir, processes, trace, metrics)
+        return
+
+    plan = load_build_plan(src_yaml, *targets[0])
 
     init_timings()
-    build_directories()
-    download_patches()
-    create_manifest()
+    run_build(plan, tgt_yaml, zip_files, zip_dir)
     
     print_timings()
-    pass
+    write_trace(trace)
+    write_metrics(metrics, plan)
 
 # ### #
 # zip #
@@ -291,29 +727,269 @@ def build(config, src_yaml, tgt_yaml, redownload, verbose, quiet):
               help="Output YAML to use with DPK")
 @click.option('--zip-dir',
               help="Output directory for PT-INFRA zip file" )
+@click.option('--volumes',
+              type=click.IntRange(1),
+              help="Number of PT-INFRA zip files to split the patches across. Default is 2.")
 @common_options
 @pass_config
-def zip(config, src_yaml, tgt_yaml, zip_dir, verbose, quiet):
+def zip(config, src_yaml, tgt_yaml, zip_dir, volumes, verbose, quiet, trace, metrics):
     """Package Infra-DPK files into a .zip file"""
 
     this.config['verbose'] = verbose
     this.config['quiet'] = quiet
-    this.config['src_yaml'] = src_yaml
     this.config['tgt_yaml'] = os.path.join(this.config[OUTPUT], tgt_yaml)
     if zip_dir:
         archive_dir = zip_dir
     else:
         archive_dir = os.path.join(this.config[OUTPUT])
     setup_logging()
+    plan = load_build_plan(src_yaml)
     init_timings()
 
-    create_zip_file(archive_dir, tgt_yaml)
+    if volumes:
+        this.config['zip_volumes'] = volumes
+    create_zip_file(plan, archive_dir, tgt_yaml)
 
     print_timings()
+    write_trace(trace)
+    write_metrics(metrics, plan)
+
+# #### #
+# plan #
+# #### #
+@cli.command()
+@click.option('-s', '--src-yaml', 
+              default="byop.yaml", 
+              show_default=True,
+              help="Input YAML with IDPK Patches")
+@click.option('--refresh-search',
+              default=False,
+              is_flag=True,
+              help="Ignore cached MOS search results - search MOS for every patch.")
+@common_options
+@pass_config
+def plan(config, src_yaml, refresh_search, verbose, quiet, trace, metrics):
+    """Check every patch on MOS and report what a build would download"""
+
+    this.config['verbose'] = verbose
+    this.config['quiet'] = quiet
+    setup_logging()
+
+    this.config['refresh_search'] = refresh_search
+    if not config.get('download_threads'):
+        this.config['download_threads'] = 2
+    if not config.get('download_segments'):
+        this.config['download_segments'] = 4
+    __set_rate_limit(this.config.get('max_rate'))
+
+    build_plan = load_build_plan(src_yaml)
+
+    init_timings()
+    try:
+        os.makedirs(this.config[TEMP], exist_ok = True)
+    except OSError as error:
+        logging.error("Directory '%s' can not be created" % this.config[TEMP])
+    __create_patch_status()
+
+    sections = plan_patches(build_plan)
+    missing = print_plan(sections)
+
+    print_timings()
+    write_trace(trace)
+    write_metrics(metrics, build_plan)
+    if missing:
+        exit(2)
 
 # ################# #
 # Library Functions #
 # ################# #
+def run_build(plan, tgt_yaml, zip_files, zip_dir):
+    build_directories()
+    if zip_files:
+        # package each patch as soon as it lands in cpu_archives, then finish the zips at the end
+        archive_dir = zip_dir or this.config[OUTPUT]
+        zip_base = __zip_basename(plan)
+        __start_packager(__zip_paths(archive_dir, zip_base))
+    try:
+        download_patches(plan)
+    finally:
+        __finish_packager()
+    create_manifest(plan)
+    if zip_files:
+        create_zip_file(plan, archive_dir, tgt_yaml, zip_base)
+
+def build_matrix(src_yaml, targets, tgt_yaml, zip_files, zip_dir, processes, trace, metrics):
+    # Every platform/PeopleTools pair is built by its own process, in its own output directory.
+    # They share the MOS session, the search cache and the patch store, so a file is downloaded once.
+    plans = [load_build_plan(src_yaml, platform, ptversion) for platform, ptversion in targets]
+    names = [__target_name(plan) for plan in plans]
+    if len(set(names)) < len(names):
+        logging.error("--platform and --peopletools name the same target more than once")
+        exit(2)
+
+    init_timings()
+    if not this.config.get(STORE):
+        this.config[STORE] = os.path.join(this.config[TEMP], 'store')
+    for directory in (this.config[TEMP], os.path.join(this.config[STORE], 'objects'), os.path.join(this.config[STORE], 'locks')):
+        try:
+            os.makedirs(directory, exist_ok = True)
+        except OSError as error:
+            logging.error("Directory '%s' can not be created" % directory)
+    # log in and search MOS once here - the workers start from the saved session and the links found
+    searches = __search_targets(plans)
+    this.session = None
+
+    processes = min(processes or len(plans), len(plans))
+    logging.info("Building " + ", ".join(names) + " with " + str(processes) + " processes")
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        builds = []
+        for index, plan in enumerate(plans):
+            name = names[index]
+            span = start_span(name, 'target')
+            this.timing_spans[name] = span
+            settings = __target_settings(plan, name, processes, tgt_yaml, zip_files, zip_dir, trace, metrics)
+            settings['searches'] = searches
+            builds.append((name, span, pool.submit(__build_target, settings)))
+        for name, span, future in builds:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'error': str(e)}
+            end_span(span)
+            if result.get('error'):
+                logging.error(name + " failed: " + result['error'])
+                failed.append(name)
+                continue
+            # the worker's own clock - it may have waited for a free process
+            span.start = span.end - result['seconds']
+            span.bytes = result['downloaded']
+            this.timings[name] = datetime.timedelta(seconds=result['seconds'])
+            logging.info(name + " finished in " + os.path.relpath(result['output']))
+
+    print_timings()
+    write_trace(trace)
+    write_metrics(metrics)
+    if failed:
+        exit(2)
+
+def __search_targets(plans):
+    # Every patch of every target, searched once - targets often share patches, and workers
+    # searching on their own would each miss the cache the others are still filling
+    timing_key = "search patches"
+    session = __get_mos_authentication()
+    start_timing(timing_key)
+    patches = {}
+    for plan in plans:
+        for section in plan.sections:
+            for patch in section.patches:
+                patches.setdefault(__search_key(patch.number, plan.platform_code, patch.release), (patch.number, plan.platform_code, patch.release))
+
+    parent = current_span()
+    with ThreadPoolExecutor(max_workers=PLAN_THREADS, thread_name_prefix='plan') as pool:
+        found = [(key, pool.submit(__traced(parent, 'search ' + number, __search_mos_patch, 'plan'), session, number, platform, release)) 
+                 for key, (number, platform, release) in patches.items()]
+        searches = {}
+        for key, result in found:
+            links = result.result()
+            names = [link[link.rfind("=") + 1:] for link in links]
+            with this.digest_lock:
+                digests = dict((name, this.mos_digests[name]) for name in names if name in this.mos_digests)
+            searches[key] = {'links': links, 'digests': digests}
+
+    end_timing(timing_key)
+    return searches
+
+def __build_targets(platforms, ptversions):
+    # --platform linux,windows --peopletools 859 --peopletools 860 -> every pair; (None, None) uses the input YAML
+    def values(options):
+        found = []
+        for option in options:
+            for value in option.split(','):
+                if value.strip() and value.strip() not in found:
+                    found.append(value.strip())
+        return found or [None]
+    return [(platform, ptversion) for ptversion in values(ptversions) for platform in values(platforms)]
+
+def __target_name(plan):
+    return plan.platform_short + '-' + plan.tools_version
+
+def __target_settings(plan, name, processes, tgt_yaml, zip_files, zip_dir, trace, metrics):
+    config = dict(this.config)
+    output = os.path.join(this.config[OUTPUT], name)
+    config[OUTPUT] = output
+    config[ARCHIVE] = os.path.join(output, 'cpu_archives')
+    config[MANIFEST] = os.path.join(output, MANIFEST)
+    config[TEMP] = os.path.join(this.config[TEMP], name)
+    config[STATUS] = os.path.join(config[TEMP], STATUS)
+    config[CACHE] = this.config.get(CACHE) or this.config[TEMP]
+    config['tgt_yaml'] = os.path.join(output, tgt_yaml)
+    # metrics_file belongs to the parent - each target writes its own copy next to it
+    config.pop('metrics_file', None)
+    # the timing table is printed once, for all targets
+    config['quiet'] = True
+    # limits are for the whole build - each process gets its share
+    if this.rate_limiter:
+        config['max_rate'] = str(this.rate_limiter.rate / processes)
+    if config.get('max_host_connections'):
+        config['max_host_connections'] = max(int(config['max_host_connections']) // processes, 1)
+    return {
+        'name': name,
+        'config': config,
+        'src_yaml': plan.src_yaml,
+        'platform': plan.platform,
+        'ptversion': plan.ptversion,
+        'tgt_yaml': tgt_yaml,
+        'zip_files': zip_files,
+        'zip_dir': zip_dir,
+        'trace': __target_path(trace, name),
+        'metrics': __target_path(metrics or this.config.get('metrics_file'), name)
+    }
+
+def __target_path(path, name):
+    # build.json -> build-LNX-8.59.json
+    if not path:
+        return None
+    root, ext = os.path.splitext(path)
+    return root + '-' + name + ext
+
+def __build_target(settings):
+    # Runs in a worker process - nothing from the parent's MOS session or caches is reused in memory
+    this.config = Config(settings['config'])
+    this.total_time_key = 'TOTAL TIME'
+    this.timings_printed = False
+    this.session = None
+    this.auth_generation = 0
+    this.search_cache = None
+    this.resolved_searches = settings['searches']
+    this.patch_status = None
+    this.target_yaml = None
+    this.packager = None
+    this.mos_digests = {}
+    this.file_digests = {}
+    logging.getLogger().handlers = []
+    setup_logging(settings['name'] + ': ')
+    __set_rate_limit(this.config.get('max_rate'))
+
+    started = time.perf_counter()
+    try:
+        plan = load_build_plan(settings['src_yaml'], settings['platform'], settings['ptversion'])
+        init_timings('build')
+        run_build(plan, settings['tgt_yaml'], settings['zip_files'], settings['zip_dir'])
+        write_trace(settings['trace'])
+        write_metrics(settings['metrics'], plan)
+    except SystemExit as e:
+        # byop exits on errors it has already logged
+        if e.code:
+            return {'error': "exit code " + str(e.code)}
+
+    spans, totals = __span_totals()
+    return {
+        'seconds': time.perf_counter() - started,
+        'downloaded': sum(totals.get(span.id, 0) for section, patch, span in this.patch_spans),
+        'output': this.config[OUTPUT]
+    }
+
 def build_directories():
     try:
         os.makedirs(this.config[OUTPUT], exist_ok = True)
@@ -354,131 +1030,283 @@ def build_directories():
         os.makedirs(os.path.join(this.config[TEMP]), exist_ok = True)
     except OSError as error:
         logging.error("Directory '%s' can not be created" % os.path.join(this.config[TEMP]))
+    if this.config.get(STORE):
+        try:
+            os.makedirs(os.path.join(this.config[STORE], 'objects'), exist_ok = True)
+            os.makedirs(os.path.join(this.config[STORE], 'locks'), exist_ok = True)
+        except OSError as error:
+            logging.error("Directory '%s' can not be created" % this.config[STORE])
     
     __create_patch_status()
 
-def download_patches():
-    yml, ptversion, platform = __validate_input()
-
+def download_patches(plan):
     # Get MOS Session for downloads
     session = __get_mos_authentication()
 
-    # Download patches
-    if yml.get(WEBLOGIC):
-        release = this.codes[PEOPLETOOLS][str(ptversion)][WEBLOGIC]
-        get_weblogic_patches(session, yml, WEBLOGIC, platform, release)
-    else:
-        logging.info("No Weblogic Patches")
-
-    if yml.get(WEBLOGIC_OPATCH):
-        release = this.codes[PEOPLETOOLS][str(ptversion)][WEBLOGIC_OPATCH]
-        get_weblogic_opatch_patches(session, yml, WEBLOGIC_OPATCH, platform, release)
-    else:
-        logging.info("No Weblogic OPatch Patches")
+    sections = [
+        (WEBLOGIC, get_weblogic_patches, "No Weblogic Patches"),
+        (WEBLOGIC_OPATCH, get_weblogic_opatch_patches, "No Weblogic OPatch Patches"),
+        (TUXEDO, get_tuxedo_patches, "No Tuxedo Patches"),
+        (ORACLECLIENT, get_oracleclient_patches, "No Oracle Client Patches"),
+        (ORACLECLIENT_OPATCH, get_oracleclient_opatch_patches, "No Oracle Client OPatch Patches"),
+        (JDK, get_jdk_patches, "No JDK Patches"),
+    ]
+
+    # Download patches - every section runs at once and shares one pool of
+    # download workers, so patches from all sections are in flight together
+    logging.debug("Download threads: " + str(this.config.get('download_threads')))
+    __load_target_yaml()
+    this.cpu_pool = ThreadPoolExecutor(max_workers=int(this.config.get('cpu_threads') or 2), thread_name_prefix='cpu')
+    if threading.current_thread() is threading.main_thread():
+        terminate = signal.signal(signal.SIGTERM, __terminated)
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=this.config.get('download_threads'), thread_name_prefix='download') as pool:
+            with ThreadPoolExecutor(max_workers=len(sections), thread_name_prefix='section') as runner:
+                results = []
+                for name, get_patches, message in sections:
+                    section = plan.section(name)
+                    if section:
+                        results.append(runner.submit(get_patches, pool, session, plan, section))
+                    else:
+                        logging.info(message)
 
-    if yml.get(TUXEDO):
-        release = this.codes[PEOPLETOOLS][str(ptversion)][TUXEDO]
-        get_tuxedo_patches(session, yml, TUXEDO, platform, release)
-    else:
-        logging.info("No Tuxedo Patches")
+                try:
+                    for result in results:
+                        result.result()
+                except KeyboardInterrupt:
+                    # save how far each download got before waiting on the workers
+                    __save_open_parts()
+                    raise
+        __record_throughput(time.perf_counter() - started)
+    finally:
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, terminate)
+        this.cpu_pool.shutdown()
+        this.cpu_pool = None
+        __flush_patch_status(force=True)
+        __save_target_yaml()
+
+    __log_connections()
+
+def plan_patches(plan):
+    # Resolve every patch that isn't downloaded yet - one login, all searches at once, nothing downloaded
+    timing_key = "plan patches"
+    session = __get_mos_authentication()
+    start_timing(timing_key)
 
-    if yml.get(ORACLECLIENT):
-        release = this.codes[PEOPLETOOLS][str(ptversion)][ORACLECLIENT]
-        get_oracleclient_patches(session, yml, ORACLECLIENT, platform, release)
-    else:
-        logging.info("No Oracle Client Patches")
+    sections = []
+    parent = current_span()
+    with ThreadPoolExecutor(max_workers=PLAN_THREADS, thread_name_prefix='plan') as pool:
+        for section in plan.sections:
+            patches = []
+            for patch in section.patches:
+                status = __get_patch_status(patch.number, plan.platform_code, patch.release, section.product)
+                if status:
+                    count('patch_status_hits')
+                    patches.append((patch, status['files'], None))
+                else:
+                    patches.append((patch, None, pool.submit(__traced(parent, 'resolve ' + patch.number, __resolve_patch, 'plan'), 
+                                                             session, patch.number, plan.platform_code, patch.release)))
+            sections.append((section, patches))
+
+        results = []
+        for section, patches in sections:
+            results.append((section, [(patch, downloaded, resolved.result() if resolved else None) for patch, downloaded, resolved in patches]))
+            for patch, downloaded, resolved in results[-1][1]:
+                if downloaded is None and not resolved:
+                    logging.error(" - " + section.name + " patch " + patch.number + " was not found on MOS")
 
-    if yml.get(ORACLECLIENT_OPATCH):
-        release = this.codes[PEOPLETOOLS][str(ptversion)][ORACLECLIENT_OPATCH]
-        get_oracleclient_opatch_patches(session, yml, ORACLECLIENT_OPATCH, platform, release)
-    else:
-        logging.info("No Oracle Client OPatch Patches")
-    
-    if yml.get(JDK):
-        release = this.codes[PEOPLETOOLS][str(ptversion)][JDK]
-        get_jdk_patches(session, yml, JDK, platform, release)
-    else:
-        logging.info("No JDK Patches")
+    end_timing(timing_key)
+    return results
 
-def create_manifest():
-    logging.info("Creating " + MANIFEST)
-    yml, ptversion, platform = __validate_input()
-    
-    regex = r"(\d{1})\.?(\d{2})"
-    pattern = "\\1.\\2"
-    ptversion = re.sub(regex, pattern, ptversion)
+def __resolve_patch(session, patch, platform, release):
+    # The files a patch would download, with their sizes and whether a copy is already here
+    files = []
+    for link in __search_mos_patch(session, patch, platform, release):
+        name = link[link.rfind("=") + 1:]
+        size = __link_size(session, link)
+        local = os.path.join(this.config[TEMP], name)
+        if size and os.path.exists(local) and os.path.getsize(local) == size:
+            files.append({'name': name, 'size': size, 'local': True})
+        else:
+            files.append({'name': name, 'size': size, 'local': bool(size and __stored_file(name, size))})
+    return files
 
-    if os.path.exists(this.config.get(MANIFEST)):
-        with open(this.config.get(MANIFEST), 'r') as manifest:
-            manifest = yaml.load(this.config.get("src_yaml"), Loader=yaml.FullLoader) or {}
+def __link_size(session, url):
+    # HEAD follows MOS's redirect to the file; a server that won't answer HEAD gets a GET that is closed unread
+    generation = this.auth_generation
+    try:
+        r = session.head(url, allow_redirects=True)
+        if __mos_rejected(r):
+            __renew_mos_authentication(generation)
+            r = session.head(url, allow_redirects=True)
+        if not r.ok or not r.headers.get('Content-Length'):
+            r = session.get(url, stream=True, allow_redirects=True)
+            r.close()
+    except requests.exceptions.RequestException as e:
+        logging.warning(" - Could not get the size of " + url + ": " + str(e))
+        return None
+    if not r.ok:
+        logging.warning(" - Could not get the size of " + url + ": " + str(r.status_code))
+        return None
+    return int(r.headers.get('Content-Length') or 0) or None
+
+def print_plan(sections):
+    # One line per section, a line per patch with --verbose, and the total with an estimate
+    rate, source = __expected_throughput()
+    header = "------------------------------------------------------------------------"
+    print(header)
+    print('{:29}'.format("Section") + "{:>8}{:>7}{:>11}{:>11}{:>10}".format("Patches", "Files", "MB", "Download", "ETA"))
+    print(header)
+    total_files = total_bytes = total_download = 0
+    unknown = False
+    missing = []
+    for section, patches in sections:
+        files = size = download = done = 0
+        for patch, downloaded, resolved in patches:
+            if downloaded is not None:
+                done += 1
+                files += len(downloaded)
+                size += sum(file.get('size') or 0 for file in downloaded)
+                logging.debug(" - " + patch.number + ": already downloaded")
+                continue
+            if not resolved:
+                missing.append(section.name + " " + patch.number)
+                continue
+            for file in resolved:
+                files += 1
+                size += file['size'] or 0
+                if not file['local']:
+                    download += file['size'] or 0
+                unknown = unknown or not file['size']
+                logging.debug(" - " + patch.number + ": " + file['name'] + " " + (str(file['size']) if file['size'] else "unknown") + 
+                              " bytes" + (" (already here)" if file['local'] else ""))
+        total_files += files
+        total_bytes += size
+        total_download += download
+        name = section.name + (" (" + str(done) + " done)" if done else "")
+        print('{:29}'.format(name) + "{:>8}{:>7}{:>11.1f}{:>11.1f}{:>10}".format(
+            len(patches), files, size / 1024 / 1024, download / 1024 / 1024, __format_eta(download, rate)))
+    print(header)
+    print('{:29}'.format("TOTAL") + "{:>8}{:>7}{:>11.1f}{:>11.1f}{:>10}".format(
+        sum(len(patches) for section, patches in sections), total_files, total_bytes / 1024 / 1024, total_download / 1024 / 1024,
+        __format_eta(total_download, rate)))
+    print(header)
+    if rate:
+        print("ETA at {:.1f} MB/s, ".format(rate / 1024 / 1024) + source)
     else:
-        manifest = {}
+        print("No ETA - no build has measured the download speed yet")
+    if unknown:
+        print("MOS did not report the size of some files - the totals are low")
+    for patch in missing:
+        print("NOT FOUND: " + patch)
+    return missing
+
+def __format_eta(amount, rate):
+    if not amount:
+        return "-"
+    if not rate:
+        return "?"
+    hours, remainder = divmod(amount / rate, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return "{:02.0f}:{:02.0f}:{:02.0f}".format(hours, minutes, seconds)
+
+def __record_throughput(seconds):
+    # What this build pulled from MOS, for byop plan's estimates - small builds say little about the link
+    downloaded = 0
+    spans, totals = __span_totals()
+    for section, patch, span in this.patch_spans:
+        downloaded += totals.get(span.id, 0)
+    if downloaded < THROUGHPUT_MIN_BYTES or seconds <= 0:
+        return
+    with this.status_lock:
+        this.patch_status['throughput'] = {
+            'bytes': downloaded,
+            'seconds': round(seconds, 3),
+            'measured': datetime.datetime.now().isoformat(timespec='seconds')
+        }
+        this.status_dirty = True
+
+def __expected_throughput():
+    # the speed of the last build, unless max_rate holds downloads below it
+    with this.status_lock:
+        measured = (this.patch_status or {}).get('throughput')
+    if this.rate_limiter and (not measured or this.rate_limiter.rate < measured['bytes'] / measured['seconds']):
+        return this.rate_limiter.rate, "the max_rate limit"
+    if measured:
+        return measured['bytes'] / measured['seconds'], "measured by the last build on " + measured['measured'][:10]
+    return None, None
+
+def create_manifest(plan):
+    logging.info("Creating " + MANIFEST)
 
-    manifest = yml['manifest']
+    manifest = dict(plan.manifest)
     manifest['type'] = 'tools-infra'
-    manifest['platform'] = yml['platform'].capitalize()
-    manifest['tools_version'] = ptversion
-    manifest['min_tools_version'] = ptversion
+    manifest['platform'] = plan.platform.capitalize()
+    manifest['tools_version'] = plan.tools_version
+    manifest['min_tools_version'] = plan.tools_version
 
     with open(this.config.get(MANIFEST), 'w') as f:
         for key, value in manifest.items():
             f.write('%s=%s\n' % (key, value))
 
-def create_zip_file(archive_dir, tgt_yaml):
+def create_zip_file(plan, archive_dir, tgt_yaml, basename=None):
     timing_key = "create zip file"
     start_timing(timing_key)
 
-    yml, ptversion, platform = __validate_input()
-    regex = r"(\d{1})\.?(\d{2})"
-    pattern = "\\1.\\2"
-    ptversion = re.sub(regex, pattern, ptversion)
+    manifest = os.path.basename(this.config.get(MANIFEST))
+    basename = basename or __zip_basename(plan)
+    zip_paths = __zip_paths(archive_dir, basename)
+    volumes = len(zip_paths)
+    this.archives = zip_paths
+
+    folders, files = __archive_contents()
+    assigned = __assign_volumes(files, zip_paths)
+    empty = [(arcdir, dirname) for arcdir, dirname in folders if not any(arcname.startswith(arcdir) for arcname, path, size in files)]
+
+    os.makedirs(archive_dir, exist_ok=True)
+    # each volume is written by its own thread - there is no chdir, so they don't interfere
+    parent = current_span()
+    with ThreadPoolExecutor(max_workers=volumes, thread_name_prefix='zip') as pool:
+        futures = []
+        for index, zip_path in enumerate(zip_paths):
+            # psft_patches.yaml and the empty product folders go in the first volume, the manifest in every volume
+            if index == 0:
+                entries = __zip_entries(folders, assigned[index], empty, [tgt_yaml, manifest])
+            else:
+                entries = __zip_entries(folders, assigned[index], [], [manifest])
+            futures.append(pool.submit(__traced(parent, os.path.basename(zip_path), __zipvolume, 'zip'), zip_path, entries))
+        for future in futures:
+            future.result()
 
-    platform = yml['platform']
+        with timed('checksums', 'io'):
+            __write_checksums(pool, os.path.join(archive_dir, basename + '.sha256'), zip_paths, files)
 
-    if platform == 'linux':
-        platform_short = 'LNX'
-    elif platform == 'windows':
-        platform_short = 'WIN'
-    now = datetime.datetime.now()
-    date = now.strftime("%y%m%d")
-
-    zipno = '1'
-    zipname = 'PT-INFRA-DPK-' + platform_short + '-' + ptversion + '-' + date + '_' + zipno + 'of2.zip'
-    logging.debug("Infra-DPK zip file name: " + zipname)
-    zipfolders = [JDK_PATCHES, TUXEDO_PATCHES, WEBLOGIC_PATCHES, WEBLOGIC_OPATCH_PATCHES]
-    __zipdirectory(zipname, zipfolders)
-    logging.info("Created " + zipname)
-    logging.debug("Adding " + tgt_yaml + " to zip 1")
-    __zipyaml(zipname, tgt_yaml)
-    logging.debug("Adding " + MANIFEST + " to zip 1")
-    __zipyaml(zipname, os.path.basename(this.config.get(MANIFEST)))
-
-    zipno = '2'
-    zipname = 'PT-INFRA-DPK-' + platform_short + '-' + ptversion + '-' + date + '_' + zipno + 'of2.zip'
-    logging.debug("Infra-DPK zip file name: " + zipname)
-    zipfolders = [ORACLECLIENT_PATCHES, ORACLECLIENT_OPATCH_PATCHES]
-    __zipdirectory(zipname, zipfolders)
-    logging.debug("Adding " + MANIFEST + " to zip 2")
-    __zipyaml(zipname, os.path.basename(this.config.get(MANIFEST)))
-    logging.info("Created " + zipname)
-    
     end_timing(timing_key)
 
-def get_weblogic_patches(session, yml, section, platform, release):
+def __yaml_file(patch, files):
+    # psft_patches.yaml has one file per patch - the last one MOS lists, as byop has always used
+    if len(files) > 1:
+        logging.warning(" - Patch " + str(patch.number) + " has " + str(len(files)) + " files, only " + files[-1] + 
+                        " is added to psft_patches.yaml (not " + ", ".join(files[:-1]) + ")")
+    return files[-1]
+
+def get_weblogic_patches(pool, session, plan, section):
     timing_key = "weblogic patches"
     start_timing(timing_key)
     
     weblogic_patches = {}
     weblogic_patches_version = {}
 
-    logging.info("Downloading " + str(len(yml[section])) + " patches for Weblogic")
+    logging.info("Downloading " + str(len(section.patches)) + " patches for Weblogic")
     downloaded = False
-    for i, patch in enumerate(yml[section], start=1):
-        file_name = __get_patch(session, patch, platform, release, WEBLOGIC_PATCHES)
-        if file_name:
+    for patch, download in __submit_patches(pool, session, plan, section):
+        files = download.result()
+        if files:
             downloaded = True
-            weblogic_patches_version["patch" + str(i)] = str(patch)
-            weblogic_patches["patch" + str(i)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + WEBLOGIC_PATCHES + '/' + file_name
+            weblogic_patches_version["patch" + str(patch.index)] = patch.number
+            weblogic_patches["patch" + str(patch.index)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + WEBLOGIC_PATCHES + '/' + __yaml_file(patch, files)
 
     if downloaded:
         logging.debug(WEBLOGIC_PATCHES_VERSION + ": ")
@@ -491,19 +1319,19 @@ def get_weblogic_patches(session, yml, section, platform, release):
 
     end_timing(timing_key)
 
-def get_weblogic_opatch_patches(session, yml, section, platform, release):
+def get_weblogic_opatch_patches(pool, session, plan, section):
     timing_key = "weblogic opatch patches"
     start_timing(timing_key)
     
     patches = {}
 
-    logging.info("Downloading " + str(len(yml[section])) + " patches for Weblogic OPatch Patches")
+    logging.info("Downloading " + str(len(section.patches)) + " patches for Weblogic OPatch Patches")
     downloaded = False
-    for i, patch in enumerate(yml[section], start=1):
-        file_name = __get_patch(session, patch, platform, release, WEBLOGIC_OPATCH_PATCHES)
-        if file_name:
+    for patch, download in __submit_patches(pool, session, plan, section):
+        files = download.result()
+        if files:
             downloaded = True
-            patches["patch" + str(i)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + WEBLOGIC_OPATCH_PATCHES + '/' + file_name
+            patches["patch" + str(patch.index)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + WEBLOGIC_OPATCH_PATCHES + '/' + __yaml_file(patch, files)
 
     if downloaded:
         logging.debug(WEBLOGIC_OPATCH_PATCHES + ": ")
@@ -512,22 +1340,21 @@ def get_weblogic_opatch_patches(session, yml, section, platform, release):
 
     end_timing(timing_key)
 
-def get_tuxedo_patches(session, yml, section, platform, release):
+def get_tuxedo_patches(pool, session, plan, section):
     timing_key = "tuxedo patches"
     start_timing(timing_key)
     
     tuxedo_patches = {}
     tuxedo_patches_version = {}
 
-    logging.info("Downloading " + str(len(yml[section])) + " patches for Tuxedo")
+    logging.info("Downloading " + str(len(section.patches)) + " patches for Tuxedo")
     downloaded = False
-    for i, patch in enumerate(yml[section], start=1):
-        patch,version=patch.split(':', 1)
-        file_name = __get_patch(session, patch, platform, release, TUXEDO_PATCHES)
-        if file_name:
+    for patch, download in __submit_patches(pool, session, plan, section):
+        files = download.result()
+        if files:
             downloaded = True
-            tuxedo_patches_version["patch" + str(i)] = str(version)
-            tuxedo_patches["patch" + str(i)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + TUXEDO_PATCHES + '/' + file_name
+            tuxedo_patches_version["patch" + str(patch.index)] = patch.version
+            tuxedo_patches["patch" + str(patch.index)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + TUXEDO_PATCHES + '/' + __yaml_file(patch, files)
 
     if downloaded:
         logging.debug(TUXEDO_PATCHES_VERSION + ": ")
@@ -540,21 +1367,21 @@ def get_tuxedo_patches(session, yml, section, platform, release):
 
     end_timing(timing_key)
 
-def get_oracleclient_patches(session, yml, section, platform, release):
+def get_oracleclient_patches(pool, session, plan, section):
     timing_key = "oracleclient patches"
     start_timing(timing_key)
     
     oracleclient_patches = {}
     oracleclient_patches_version = {}
 
-    logging.info("Downloading " + str(len(yml[section])) + " patches for Oracle Client")
+    logging.info("Downloading " + str(len(section.patches)) + " patches for Oracle Client")
     downloaded = False
-    for i, patch in enumerate(yml[section], start=1):
-        file_name = __get_patch(session, patch, platform, release, ORACLECLIENT_PATCHES)
-        if file_name:
+    for patch, download in __submit_patches(pool, session, plan, section):
+        files = download.result()
+        if files:
             downloaded = True
-            oracleclient_patches_version["patch" + str(i)] = str(patch)
-            oracleclient_patches["patch" + str(i)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + ORACLECLIENT_PATCHES + '/' + file_name
+            oracleclient_patches_version["patch" + str(patch.index)] = patch.number
+            oracleclient_patches["patch" + str(patch.index)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + ORACLECLIENT_PATCHES + '/' + __yaml_file(patch, files)
 
     if downloaded:
         logging.debug(ORACLECLIENT_PATCHES_VERSION + ": ")
@@ -567,19 +1394,19 @@ def get_oracleclient_patches(session, yml, section, platform, release):
 
     end_timing(timing_key)
 
-def get_oracleclient_opatch_patches(session, yml, section, platform, release):
+def get_oracleclient_opatch_patches(pool, session, plan, section):
     timing_key = "oracleclient opatch patches"
     start_timing(timing_key)
     
     patches = {}
 
-    logging.info("Downloading " + str(len(yml[section])) + " patches for Oracle Client OPatch Patches")
+    logging.info("Downloading " + str(len(section.patches)) + " patches for Oracle Client OPatch Patches")
     downloaded = False
-    for i, patch in enumerate(yml[section], start=1):
-        file_name = __get_patch(session, patch, platform, release, section)
-        if file_name:
+    for patch, download in __submit_patches(pool, session, plan, section):
+        files = download.result()
+        if files:
             downloaded = True
-            patches["patch" + str(i)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + ORACLECLIENT_OPATCH_PATCHES + '/' + file_name
+            patches["patch" + str(patch.index)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + ORACLECLIENT_OPATCH_PATCHES + '/' + __yaml_file(patch, files)
 
     if downloaded:
         logging.debug(ORACLECLIENT_OPATCH_PATCHES + ": ")
@@ -588,24 +1415,21 @@ def get_oracleclient_opatch_patches(session, yml, section, platform, release):
 
     end_timing(timing_key)
 
-def get_jdk_patches(session, yml, section, platform, release):
+def get_jdk_patches(pool, session, plan, section):
     timing_key = "jdk patches"
     start_timing(timing_key)
     
     jdk_patches = {}
     jdk_patches_version = {}
 
-    logging.info("Downloading " + str(len(yml[section])) + " patches for JDK")
+    logging.info("Downloading " + str(len(section.patches)) + " patches for JDK")
     downloaded = False
-    for i, patch in enumerate(yml[section], start=1):
-        patch,version = patch.split(':', 1)
-        # simple_verison = version.replace('.', '')
-        logging.debug("JDK Version: " + version)
-        file_name = __get_patch(session, patch, platform, version, JDK_PATCHES)
-        if file_name:
+    for patch, download in __submit_patches(pool, session, plan, section):
+        files = download.result()
+        if files:
             downloaded = True
-            jdk_patches_version["patch" + str(i)] = str(version)
-            jdk_patches["patch" + str(i)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + JDK_PATCHES + '/' + file_name
+            jdk_patches_version["patch" + str(patch.index)] = patch.version
+            jdk_patches["patch" + str(patch.index)] = '%{hiera("peoplesoft_base")}/dpk/cpu_archives/' + JDK_PATCHES + '/' + __yaml_file(patch, files)
 
     if downloaded:
         logging.debug(JDK_PATCHES_VERSION + ": ")
@@ -618,44 +1442,87 @@ def get_jdk_patches(session, yml, section, platform, release):
 
     end_timing(timing_key)
 
+def __submit_patches(pool, session, plan, section):
+    # Queue every patch of a section on the shared download pool, in input order.
+    # Once a patch is downloaded it moves on to the CPU pool, freeing the download worker.
+    patches = []
+    for patch in section.patches:
+        patch_span = start_span('patch ' + patch.number, 'patch')
+        this.patch_spans.append((section, patch, patch_span))
+        download = pool.submit(__traced(patch_span, 'download', __get_patch), session, plan, patch.number, patch.release, section.product)
+        finished = __then(download, this.cpu_pool, __traced(patch_span, 'process', __finish_patch), plan, patch.number, patch.release, section.product)
+        finished.add_done_callback(lambda done, patch_span=patch_span: end_span(patch_span))
+        patches.append((patch, finished))
+    return patches
+
+def __then(future, pool, fn, *args):
+    # Run fn(result, *args) on pool when future finishes, without tying up a thread while waiting
+    chained = Future()
+
+    def submit(done):
+        try:
+            result = done.result()
+        except BaseException as e:
+            chained.set_exception(e)
+            return
+        try:
+            stage = pool.submit(fn, result, *args)
+        except RuntimeError as e:
+            chained.set_exception(e)
+            return
+        stage.add_done_callback(lambda stage: __copy_future(stage, chained))
+
+    future.add_done_callback(submit)
+    return chained
+
+def __copy_future(source, target):
+    try:
+        target.set_result(source.result())
+    except BaseException as e:
+        target.set_exception(e)
+
 # MOS Functions
-def __get_mos_authentication():
+def __get_mos_authentication(relogin=False):
     # Copied from ioco - thanks Kyle!
     timing_key = "__get_mos_authentication"
     start_timing(timing_key)
     
     logging.info("Authenticating with MOS")
+    cookie_file = os.path.join(this.config.get(CACHE) or this.config[TEMP], 'mos.cookie')
+    s = __get_session()
+
+    # Reuse the session from an earlier run while MOS still accepts it
+    if not relogin and __load_mos_cookies(s, cookie_file):
+        if __mos_session_valid(s):
+            logging.info(" - Reusing saved MOS session")
+            end_timing(timing_key)
+            return s
+        logging.debug("Saved MOS session was rejected - logging in again")
+
     logging.debug("Creating auth cookie from MOS")
-    cookie_file = os.path.join(this.config[TEMP], 'mos.cookie')
 
     # eat any old cookies
     if os.path.exists(cookie_file):
         os.remove(cookie_file)
         
     try:
-        # Create a session and update headers
-        s = requests.session()
-        s.headers.update({'User-Agent': 'Mozilla/5.0'})
-
-        # Initiate updates.oracle.com request to get login redirect URL
+        # Initiate MOS request to get login redirect URL
         logging.debug('Requesting downloads page')
-        r = s.get("https://updates.oracle.com/Orion/Services/download", allow_redirects=False)
+        s.cookies.clear()
+        r = s.get(this.config[MOS_URL] + "/Orion/Services/download", allow_redirects=False)
         login_url = r.headers['Location']
         if not login_url:
             logging.error("Location was empty so login URL can't be set") 
             error_timings(timing_key)
             exit(2)
 
-        # Create a NEW session, then send Basic Auth to login redirect URL
-        logging.debug('Sending Basic Auth to login, using new session')
-        s = requests.session()
+        # Drop the redirect cookies, then send Basic Auth to login redirect URL
+        logging.debug('Sending Basic Auth to login, using a clean cookie jar')
+        s.cookies.clear()
         logging.debug("Using MOS username: " + this.config.get('mos_username'))
         decoded = cryptocode.decrypt(this.config.get('mos_password'), "NIswEgoOj39wpzJcqocQ8mw4iMkqtS")
         r = s.post(login_url, auth = HTTPBasicAuth(this.config.get('mos_username'), decoded))
             
-        # Save session cookies to be used by downloader later on...
-        this.config['mos_cookies'] = s.cookies
-
         # Validate login was success
         if r.ok:
             logging.info(" - MOS Login was Successful")
@@ -668,37 +1535,200 @@ def __get_mos_authentication():
         end_timing(timing_key)
         exit(4)
 
+    __save_mos_cookies(s, cookie_file)
     end_timing(timing_key)
     return s
 
-def __get_patch(session, patch, platform, release, product):
+def __renew_mos_authentication(generation):
+    # Several workers can see the session expire at once - only one logs in again
+    with this.auth_lock:
+        if this.auth_generation == generation:
+            logging.info(" - MOS session expired")
+            __get_mos_authentication(relogin=True)
+            this.auth_generation += 1
+
+def __mos_rejected(r):
+    # MOS answers an expired session with a redirect to the SSO login page
+    for response in r.history + [r]:
+        location = response.headers.get('Location') or ''
+        if response.status_code in (401, 403) or re.search(r"login|signon|/sso/", location, re.IGNORECASE):
+            return True
+    return False
+
+def __mos_session_valid(s):
+    try:
+        r = s.get(this.config[MOS_URL] + "/Orion/Services/download", allow_redirects=False)
+    except requests.exceptions.RequestException as e:
+        logging.debug("Could not validate saved MOS session: " + str(e))
+        return False
+    return r.status_code < 400 and not __mos_rejected(r)
+
+def __load_mos_cookies(s, cookie_file):
+    try:
+        with open(cookie_file) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if saved.get('username') != this.config.get('mos_username'):
+        logging.debug("Saved MOS session belongs to another user")
+        return False
+    if saved.get('expires', 0) <= time.time():
+        logging.debug("Saved MOS session has expired")
+        return False
+
+    s.cookies.clear()
+    for cookie in saved.get('cookies', []):
+        s.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], 
+                      secure=cookie['secure'], expires=cookie['expires'])
+    return len(s.cookies) > 0
+
+def __save_mos_cookies(s, cookie_file):
+    # The session is as good as the password - keep it readable by the owner only
+    now = time.time()
+    expires = [cookie.expires for cookie in s.cookies if cookie.expires]
+    saved = {
+        'username': this.config.get('mos_username'),
+        'saved': now,
+        'expires': min(expires + [now + int(this.config.get('mos_session_max_age') or 8 * 3600)]),
+        'cookies': [{'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path, 
+                     'secure': cookie.secure, 'expires': cookie.expires} for cookie in s.cookies]
+    }
+    # matrix workers renew the session at the same time - each writes its own temporary file
+    # (mkstemp creates it readable by the owner only) and the last complete one wins
+    try:
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(cookie_file) + '.', suffix='.tmp', dir=os.path.dirname(cookie_file) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp_file, cookie_file)
+        except OSError:
+            os.remove(tmp_file)
+            raise
+        logging.debug("Saved MOS session to " + cookie_file)
+    except OSError as e:
+        logging.warning("Could not save MOS session: " + str(e))
+
+def __set_rate_limit(max_rate):
+    # accepts bytes per second, optionally with a K, M or G suffix (powers of 1024)
+    this.rate_limiter = None
+    if not max_rate:
+        return
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*$", str(max_rate), re.IGNORECASE)
+    if not match:
+        logging.error("Invalid max_rate '" + str(max_rate) + "' - use bytes per second, e.g. 50M")
+        exit(2)
+    rate = float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+    if rate <= 0:
+        return
+    this.rate_limiter = RateLimiter(rate)
+    logging.debug("Download rate limit: " + str(int(rate)) + " bytes/s")
+
+def __get_session():
+    # Build the shared session once - searches, redirects and downloads all
+    # reuse its keep-alive connections
+    if this.session is None:
+        # patches, files per patch and segments per file can all be in flight at once
+        threads = int(this.config.get('download_threads') or 2)
+        connections = threads * threads * max(int(this.config.get('download_segments') or 1), 1)
+        cap = this.config.get('max_host_connections')
+        if cap:
+            # a blocking pool makes requests wait for a free connection instead of opening another
+            connections = int(cap)
+        # a stalled connection raises instead of holding a download worker forever
+        timeout = (float(this.config.get('connect_timeout') or 30), float(this.config.get('read_timeout') or 60))
+        adapter = MOSAdapter(pool_connections=10, pool_maxsize=connections, pool_block=bool(cap), max_retries=3, timeout=timeout)
+        s = requests.session()
+        s.headers.update({'User-Agent': 'Mozilla/5.0', 'Connection': 'keep-alive'})
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        this.session = s
+        logging.debug("HTTP connection pool size: " + str(connections) + (" per host (limit)" if cap else ""))
+    return this.session
+
+def __log_connections():
+    adapter = this.session.get_adapter('https://') if this.session else None
+    if adapter:
+        logging.debug("HTTP requests: " + str(adapter.requests_sent) + 
+                      ", connections opened: " + str(adapter.connections_opened) + 
+                      ", reused: " + str(adapter.requests_sent - adapter.connections_opened))
+
+def __get_patch(session, plan, patch, release, product):
     # Copied from ioco - thanks Kyle!
-    if not __get_patch_status(patch):
-        file_name = __find_mos_patch(session, patch, platform, release)
-        logging.debug(" - Downloaded File Name: " + str(file_name))
+    # Download stage - returns the downloaded file names, and whether they are already in cpu_archives
+    platform = plan.platform_code
+    status = __get_patch_status(patch, platform, release, product)
+    if not status:
+        files = __find_mos_patch(session, patch, platform, release)
+        logging.debug(" - Downloaded File Names: " + str(files))
+        return files, False
     else:
         logging.info(" - Patch already downloaded: " + str(patch))
-        return False
-
-    if file_name:
+        count('patch_status_hits')
+        return [file['name'] for file in status['files']], True
+
+def __finish_patch(downloaded, plan, patch, release, product):
+    # CPU stage - JDK repackaging, then the move to cpu_archives
+    files, archived = downloaded
+    platform = plan.platform_code
+    if archived:
+        for file in files:
+            __package_file(product, file)
+        return files
+
+    if files:
         if product == JDK_PATCHES:
             logging.info(" - Converting JDK to DPK format")
-            file_name = __convert_jdk_archive(file_name, release)
-            logging.debug("JDK Files: " + file_name + " and Release: " + release)
-        file = __copy_files(file_name, product, patch)
-
-    return file
+            # two JDK patches for the same release would write the same pt-jdk tarball
+            with this.jdk_lock, timed('convert', 'cpu'):
+                if this.config.get(STORE):
+                    __store_file(files[-1])
+                converted = __convert_jdk_archive(files[-1], release, plan.platform)
+            files = [converted] if converted else []
+            logging.debug("JDK Files: " + str(files) + " and Release: " + release)
+        with timed('move', 'io'):
+            files = __copy_files(files, product, patch, platform, release)
+
+    return files
 
 def __find_mos_patch(session, patch, platform, release):
-    # timing_key = "__find_mos_patch"
-    # start_timing(timing_key)
-
     logging.debug(" - Downloading files from MOS")
+    with timed('search', 'mos'):
+        download_links = __search_mos_patch(session, patch, platform, release)
+
+    # Validate download links
+    if len(download_links) > 0:
+        logging.debug(" - Downloading " + str(len(download_links)) + " files")
+        logging.debug(" - URL: " + str(download_links))
+    else:
+        logging.error("No download links found")
+        exit(2)
+
+    # multi thread download
+    results = __download_file(session, download_links)
+    logging.debug("Download Results: " + str(results))
+
+    return results
+
+def __search_mos_patch(session, patch, platform, release):
+    key = __search_key(patch, platform, release)
+    entry = __get_cached_search(key)
+    if entry is not None:
+        logging.debug(" - Using cached search results for " + str(patch))
+        count('search_cache_hits')
+        __remember_digests(entry.get('digests') or {})
+        return entry['links']
+    count('search_cache_misses')
+
     try:
         # Use same session to search for downloads
         logging.debug('Search for list of downloads, using same session')
-        mos_uri_search = "https://updates.oracle.com/Orion/SimpleSearch/process_form?search_type=patch&patch_number=" + str(patch) + "&plat_lang=" + str(platform)
+        mos_uri_search = this.config[MOS_URL] + "/Orion/SimpleSearch/process_form?search_type=patch&patch_number=" + str(patch) + "&plat_lang=" + str(platform)
+        generation = this.auth_generation
         r = session.get(mos_uri_search) 
+        if __mos_rejected(r):
+            __renew_mos_authentication(generation)
+            r = session.get(mos_uri_search)
         search_results = r.content.decode('utf-8')
         
         # Validate search results
@@ -706,291 +1736,1234 @@ def __find_mos_patch(session, patch, platform, release):
             logging.debug("Search results return success")
         else:
             logging.error("Search results did NOT return success")
-            # error_timings(timing_key)
             exit(3)
     except:
         logging.error("Issue getting MOS search results")
-        # end_timing(timing_key)
         raise
 
-    try:
-        # Extract download links to list
-        if release:
-            simple_release = release.replace('.', '')
-            pattern = "https.+?Download\/process_form\/.*" + simple_release + ".*\.zip*"
-        else:
-            pattern = "https.+?Download\/process_form\/.*\.zip*"
-        logging.debug("Search Pattern: " + pattern)
-        download_links = re.findall(pattern,search_results)
-        if download_links:
-            download_links_file = os.path.join(this.config[TEMP], 'mos-download.links')
-            # Write download links to file
-            f = open(download_links_file,"w")
-            for link in download_links:
-                # Write download links list to file
-                logging.debug(link)
-                f.write(link + os.linesep)
-            f.close()
-        else:
-            # Check for superseced patch
-            pattern = "https.+?Download\/process_form\/.*" + simple_release + ".*\.zip*"
+    # Extract download links to list
+    if release:
+        simple_release = release.replace('.', '')
+        pattern = "https?.+?Download\/process_form\/.*" + simple_release + ".*\.zip*"
+    else:
+        pattern = "https?.+?Download\/process_form\/.*\.zip*"
+    logging.debug("Search Pattern: " + pattern)
+    download_links = re.findall(pattern,search_results)
+    for link in download_links:
+        logging.debug(link)
+
+    digests = __get_mos_digests(session, search_results, download_links, release)
+    __remember_digests(digests)
+
+    if download_links:
+        __cache_search(key, download_links, digests)
+
+    return download_links
+
+def __search_key(patch, platform, release):
+    # Search results are cached per patch, platform and release (and MOS URL, when it is not Oracle's)
+    key = str(patch) + '|' + str(platform) + '|' + str(release or '')
+    if this.config[MOS_URL] != DEFAULT_MOS_URL:
+        key += '|' + this.config[MOS_URL]
+    return key
+
+def __get_mos_digests(session, search_results, download_links, release=None):
+    # MOS publishes a digest page next to each download - read the SHA-256/MD5 for every file.
+    # The search returns every release of the patch, so skip digest pages for other releases
+    # the same way the download links are filtered
+    names = [link[link.rfind("=") + 1:] for link in download_links]
+    simple_release = release.replace('.', '') if release else None
+    digest_links = []
+    for link in re.findall(r"https?[^\"'\s<>]+?ViewDigest[^\"'\s<>]*", search_results):
+        link = link.replace('&amp;', '&')
+        if simple_release and simple_release not in link and not any(name in link for name in names):
+            continue
+        if link not in digest_links:
+            digest_links.append(link)
+
+    digests = {}
+    for link in digest_links:
+        try:
+            r = session.get(link)
+            if not r.ok:
+                raise IOError("returned " + str(r.status_code))
+            page = r.content.decode('utf-8', 'replace')
+        except (requests.exceptions.RequestException, IOError) as e:
+            logging.warning(" - Could not read MOS checksums from " + link + ": " + str(e))
+            continue
+        for name, digest in __parse_digests(page, names).items():
+            digests.setdefault(name, digest)
+
+    if names and not digests:
+        logging.debug(" - No MOS checksums found for " + ", ".join(names))
+    return digests
+
+def __parse_digests(page, names):
+    # The digest page layout isn't documented, so only trust a digest that follows one of our
+    # file names and sits right after its SHA-256/MD5 label - a page that doesn't name the file
+    # may belong to another release or platform of the patch
+    text = re.sub(r"<[^>]+>", " ", page)
+    found = sorted((text.find(name), name) for name in names if name in text)
+
+    digests = {}
+    for i, (start, name) in enumerate(found):
+        end = found[i + 1][0] if i + 1 < len(found) else len(text)
+        sha256 = re.search(r"SHA-?256(?:\s+checksum)?[\s:=]*\b([0-9A-Fa-f]{64})\b", text[start:end], re.I)
+        md5 = re.search(r"MD5(?:\s+checksum)?[\s:=]*\b([0-9A-Fa-f]{32})\b", text[start:end], re.I)
+        if sha256 or md5:
+            digests[name] = {'sha256': sha256.group(1).lower() if sha256 else None,
+                             'md5': md5.group(1).lower() if md5 else None}
+    return digests
+
+def __remember_digests(digests):
+    with this.digest_lock:
+        this.mos_digests.update(digests)
+
+def __load_search_cache():
+    if this.search_cache is None:
+        try:
+            with open(os.path.join(this.config.get(CACHE) or this.config[TEMP], SEARCH_CACHE)) as f:
+                this.search_cache = json.load(f)
+        except (OSError, ValueError):
+            this.search_cache = {}
+    return this.search_cache
+
+def __get_cached_search(key):
+    # a matrix build's parent process already searched for this run
+    if key in this.resolved_searches:
+        return this.resolved_searches[key]
+    if this.config.get('refresh_search'):
+        return None
+
+    with this.search_lock:
+        entry = __load_search_cache().get(key)
+    # entries from older versions may hold a digest read from another release's page
+    if entry and entry.get('version') == SEARCH_CACHE_VERSION and \
+            time.time() - entry['time'] < int(this.config.get('search_cache_ttl', SEARCH_CACHE_TTL)):
+        return entry
+    return None
+
+def __cache_search(key, download_links, digests):
+    cache_file = os.path.join(this.config.get(CACHE) or this.config[TEMP], SEARCH_CACHE)
+    with this.search_lock, __file_lock(cache_file + '.lock'):
+        # other byop processes may have added searches since the cache was read
+        this.search_cache = None
+        cache = __load_search_cache()
+        cache[key] = {'version': SEARCH_CACHE_VERSION, 'time': time.time(), 'links': download_links, 'digests': digests}
+        try:
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as e:
+            logging.warning("Could not save MOS search cache: " + str(e))
 
-        # Validate download links
-        if len(download_links) > 0:
-            logging.debug(" - Downloading " + str(len(download_links)) + " files")
-            logging.debug(" - URL: " + str(download_links))
-        else:
-            logging.error("No download links found")
-            # error_timings(timing_key)
-            exit(2)
-    except:
-        logging.error("Issue creating download links file")
-        # end_timing(timing_key)
-        raise
+def __copy_files(files, product, patch, platform, release):
 
-    # multi thread download
-    # results = ThreadPool(this.config.get('download_threads')).imap_unordered(__download_file, download_links)
-    results = __download_file(download_links)
-    logging.debug("Download Results: " + str(results))
+    copied = []
+    for file in files:
+        tmp_file = os.path.join(this.config[TEMP], file)
+        target_dir = os.path.join(this.config[ARCHIVE], product, file)
 
-    # end_timing(timing_key)
-    return results
+        try:
+            if this.config.get(STORE):
+                stored = __store_file(file)
+                logging.debug("    Linking patch from  " + str(stored) + " to " + str(target_dir))
+                __link_file(stored, target_dir)
+                digest = os.path.basename(stored)
+            else:
+                logging.debug("    Moving to patch from  " + str(tmp_file) + " to " + str(target_dir))
+                shutil.move(tmp_file, target_dir)
+                digest = __known_digests(file).get('sha256') or __sha256(target_dir)
+            record = {'name': file, 'size': os.path.getsize(target_dir), 'sha256': digest}
+            known = __known_digests(file)
+            if known.get('sha256') == digest:
+                record['md5'] = known.get('md5')
+                record['verified'] = known.get('verified', False)
+            copied.append(record)
+            logging.debug("    - [DONE] " + file)
+            __package_file(product, file)
+        except FileNotFoundError: 
+            logging.error(" - Patch file " + file + " not found")
+        except PermissionError: 
+            logging.error(" - You do not have permssion to copy to " + target_dir)
+        except NotADirectoryError:
+            logging.error(" - The target directory is incorrect: " + target_dir)
+        except:
+            logging.error(" - Encountered an error moving the patch to the cpu_archives/ " + str(product) + " folder")
 
-def __copy_files(file, product, patch):
+    # Only mark the patch downloaded when every file made it to cpu_archives
+    if copied and len(copied) == len(files):
+        __update_patch_status(patch, platform, release, product, copied)
+        logging.debug("Update Patch Status - " + str(patch) + ": " + str(copied))
 
-    # for file in files:
-    tmp_file = os.path.join(this.config[TEMP], file)
-    target_dir = os.path.join(this.config[ARCHIVE], product, file)
+    return [file['name'] for file in copied]
 
-    logging.debug("    Moving to patch from  " + str(tmp_file) + " to " + str(target_dir))
+# Patch Store Functions
+def __store_file(file):
+    # Move a download into the shared store, named by its SHA-256
+    tmp_file = os.path.join(this.config[TEMP], file)
+    if not os.path.exists(tmp_file):
+        stored = __stored_file(file)
+        if not stored:
+            raise FileNotFoundError(tmp_file)
+        return stored
+
+    digest = __known_digests(file).get('sha256') or __sha256(tmp_file)
+    size = os.path.getsize(tmp_file)
+    stored = os.path.join(this.config[STORE], 'objects', digest[:2], digest)
+    os.makedirs(os.path.dirname(stored), exist_ok = True)
+    if os.path.exists(stored):
+        logging.debug("    " + file + " is already in the patch store")
+        os.remove(tmp_file)
+    else:
+        shutil.move(tmp_file, stored + '.tmp')
+        os.replace(stored + '.tmp', stored)
+
+    with this.store_lock, __file_lock(os.path.join(this.config[STORE], STORE_INDEX + '.lock')):
+        # other build directories share the index - merge with what is on disk
+        index = __load_store_index()
+        index[file] = {'sha256': digest, 'size': size}
+        index_file = os.path.join(this.config[STORE], STORE_INDEX)
+        with open(index_file + '.' + str(os.getpid()), 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(index_file + '.' + str(os.getpid()), index_file)
+
+    return stored
+
+def __unstore_file(file):
+    # Forget a store entry that no longer matches MOS - the object stays for any other names that use it
+    with this.store_lock, __file_lock(os.path.join(this.config[STORE], STORE_INDEX + '.lock')):
+        index = __load_store_index()
+        if index.pop(file, None) is None:
+            return
+        index_file = os.path.join(this.config[STORE], STORE_INDEX)
+        with open(index_file + '.' + str(os.getpid()), 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(index_file + '.' + str(os.getpid()), index_file)
+
+def __stored_file(file, size=None):
+    # Path of a file name in the shared store, if it is there (and the expected size)
+    if not this.config.get(STORE):
+        return None
+    with this.store_lock:
+        entry = __load_store_index().get(file)
+    if not entry:
+        return None
+    stored = os.path.join(this.config[STORE], 'objects', entry['sha256'][:2], entry['sha256'])
+    if not os.path.exists(stored) or (size and os.path.getsize(stored) != size):
+        return None
+    return stored
+
+def __load_store_index():
     try:
-        shutil.move(tmp_file, target_dir)
-        logging.debug("    - [DONE] " + file)
-    except FileNotFoundError: 
-        logging.error(" - Patch file " + file + " not found")
-    except PermissionError: 
-        logging.error(" - You do not have permssion to copy to " + target_dir)
-    except NotADirectoryError:
-        logging.error(" - The target directory is incorrect: " + target_dir)
-    except:
-        logging.error(" - Encountered an error moving the patch to the cpu_archives/ " + str(product) + " folder")
-
-    __update_patch_status(patch, True)
-    logging.debug("Update Patch Status - " + str(patch) + ": true")
-
-    return file # The last filename - should only be one patch in the list
+        with open(os.path.join(this.config[STORE], STORE_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def __link_file(source, target):
+    # Hardlink, then reflink, then fall back to a plain copy across filesystems
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+        return
+    except OSError as e:
+        logging.debug("    Hardlink failed (" + str(e) + "), trying a reflink")
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except (ImportError, OSError) as e:
+        logging.debug("    Reflink failed (" + str(e) + "), copying")
+    shutil.copy2(source, target)
+
+@contextlib.contextmanager
+def __file_lock(path):
+    # An exclusive lock shared with other byop processes, held for the with block
+    with open(path, 'a') as f:
+        try:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds - keep waiting
+                    pass
+        yield
+        # closing the file releases the lock
+
+def __known_digests(file):
+    # digests worked out while the file was downloaded
+    with this.digest_lock:
+        return this.file_digests.get(file) or {}
+
+def __sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+def __download_file(session, urls):
+    # multi-file patches download all of their links at once
+    parent = current_span()
+    with ThreadPoolExecutor(max_workers=this.config.get('download_threads'), thread_name_prefix='file') as pool:
+        files = list(pool.map(lambda url: __traced(parent, url[url.rfind("=") + 1:], __download_url, 'file')(session, url), urls))
+
+    # A patch is only usable when all of its files arrived
+    if None in files:
+        logging.error(" - " + str(files.count(None)) + " of " + str(len(files)) + " files failed to download")
+        return []
+
+    return files
+
+def __download_url(s, url):
+    if not this.config.get(STORE):
+        return __fetch_url(s, url)
+    # Builds that share a store (a matrix build, or several build directories) download each file once -
+    # one process downloads it into the store, and the others wait and find it there
+    file_name = url[url.rfind("=") + 1:]
+    with __file_lock(os.path.join(this.config[STORE], 'locks', file_name + '.lock')):
+        file_name = __fetch_url(s, url)
+        if file_name and os.path.exists(os.path.join(this.config[TEMP], file_name)):
+            __store_file(file_name)
+        return file_name
+
+def __fetch_url(s, url):
+    # assumes that the last segment after the = represents the file name
+    # if url is abc/xyz?patch_file=file.zip, the file name will be file.zip
+    file_name_start_pos = url.rfind("=") + 1
+    file_name = url[file_name_start_pos:]
+    path = os.path.join(this.config[TEMP], file_name)
+    generation = this.auth_generation
+    r = __probe_url(s, url)
+    if r is not None and __mos_rejected(r):
+        r.close()
+        __renew_mos_authentication(generation)
+        r = __probe_url(s, url)
+    if r is None:
+        return None
+    logging.debug("Response Code: " + str(r.status_code))
+    if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+        logging.error(" - Download failed for " + file_name + ": " + str(r.status_code))
+        return None
+
+    # Finished files are only promoted from .part once complete
+    length = __probe_length(r)
+    if length and os.path.exists(path) and os.path.getsize(path) == length:
+        r.close()
+        logging.info(" - File already downloaded: " + file_name)
+        return file_name if __verify_download(file_name, path, __file_digests(path)) else None
+    stored = __stored_file(file_name, length) if length else None
+    if stored:
+        r.close()
+        # the store names files by their SHA-256, which was checked when it was downloaded
+        if __verify_download(file_name, stored, {'sha256': os.path.basename(stored), 'md5': None}):
+            logging.info(" - Using " + file_name + " from the patch store")
+            count('patch_store_hits')
+            return file_name
+        logging.warning(" - Dropping " + file_name + " from the patch store and downloading it again")
+        __unstore_file(file_name)
+        r = __probe_url(s, url)
+        if r is None:
+            return None
+
+    part = __load_part(path, r, length)
+    if part:
+        written = sum(segment[2] for segment in part['segments'])
+        logging.info(" - Resuming " + file_name + " at " + str(written) + " of " + str(length) + " bytes")
+        count('download_resumes')
+    else:
+        part = __create_part(path, url, r, length, __plan_segments(r, length))
+        if len(part['segments']) > 1:
+            logging.debug(" - Downloading " + file_name + " in " + str(len(part['segments'])) + " segments")
 
-def __download_file(urls):
-    # assumes that the last segment after the / represents the file name
-    # if url is abc/xyz/file.txt, the file name will be file.txt
-    for url in urls:
-        file_name_start_pos = url.rfind("=") + 1
-        file_name = url[file_name_start_pos:]
-        s = requests.session()
-        s.cookies =  this.config.get('mos_cookies') 
-        r = s.get(url, stream=True, allow_redirects=True)
-        logging.debug("Response Code: " + str(r.status_code))
-        if r.status_code == 302:
-            r = s.get(r.headers['Location'])
-            logging.debug("Redirect URL: " + str(r.headers['Location']))
-        if r.status_code == requests.codes.ok:
-            with open(this.config[TEMP] + "/" + file_name, 'wb') as f: 
-                for data in r:
-                    f.write(data)
-
-    return file_name
+    try:
+        try:
+            digests = __download_part(s, r, path, part)
+        except RangeError as e:
+            logging.warning(" - Segmented download of " + file_name + " failed, retrying as a single stream: " + str(e))
+            count('download_retries')
+            r = s.get(url, stream=True, allow_redirects=True)
+            part = __create_part(path, url, r, length, [])
+            digests = __download_part(s, r, path, part)
+    except (requests.exceptions.RequestException, IOError) as e:
+        logging.error(" - Download of " + file_name + " was interrupted and will resume on the next run: " + str(e))
+        count('download_failures')
+        return None
+
+    return file_name if __verify_download(file_name, path, digests) else None
+
+def __probe_url(s, url):
+    # Ask for the first byte only - enough for the length and validators, and reading it hands
+    # the connection back to the pool. A server without ranges sends the whole file instead.
+    # Retried like a byte range; None once the retries run out
+    retries = int(this.config.get('download_retries') or 0)
+    attempt = 0
+    while True:
+        try:
+            r = s.get(url, headers={'Range': 'bytes=0-0'}, stream=True, allow_redirects=True)
+            break
+        except requests.exceptions.RequestException as e:
+            attempt += 1
+            if attempt > retries:
+                logging.error(" - Download of " + url[url.rfind("=") + 1:] + " failed and will resume on the next run: " + str(e))
+                count('download_failures')
+                return None
+            logging.warning(" - Retrying download request after error: " + str(e))
+            count('download_retries')
+    if r.status_code == requests.codes.partial_content:
+        try:
+            r.content
+        except requests.exceptions.RequestException:
+            # the headers are all that's needed - only the connection is lost
+            r.close()
+    return r
+
+def __probe_length(r):
+    if r.status_code == requests.codes.partial_content:
+        total = r.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else 0
+    return int(r.headers.get('Content-Length') or 0)
+
+def __verify_download(file_name, path, digests):
+    # Compare with the checksums MOS publishes - a bad file is removed so the next run downloads it again
+    with this.digest_lock:
+        expected = this.mos_digests.get(file_name) or {}
+    verified = None
+    for algorithm in ('sha256', 'md5'):
+        if expected.get(algorithm) and digests.get(algorithm):
+            if expected[algorithm] != digests[algorithm]:
+                logging.error(" - " + file_name + " is corrupt: " + algorithm + " is " + digests[algorithm] + 
+                              ", MOS has " + expected[algorithm])
+                if os.path.dirname(path) == this.config[TEMP]:
+                    os.remove(path)
+                return False
+            verified = algorithm
+            break
+
+    if verified:
+        logging.debug(" - " + file_name + " matches the MOS " + verified + " checksum")
+    else:
+        logging.debug(" - No MOS checksum to verify " + file_name + " against")
+    with this.digest_lock:
+        this.file_digests[file_name] = dict(digests, verified=bool(verified))
+    return True
+
+def __file_digests(path):
+    # one read for files that were not hashed while downloading
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(data)
+            md5.update(data)
+    return {'sha256': sha256.hexdigest(), 'md5': md5.hexdigest()}
+
+def __plan_segments(r, length):
+    # Split the file into byte ranges when the server supports them
+    segments = int(this.config.get('download_segments') or 1)
+    if segments < 2 or length < int(this.config.get('segment_min_size') or 0):
+        return []
+    if not __accepts_ranges(r):
+        logging.debug(" - Server does not accept byte ranges - using a single stream")
+        return []
+
+    size = -(-length // segments)
+    return [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+
+def __accepts_ranges(r):
+    return r.status_code == requests.codes.partial_content or r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+def __create_part(path, url, r, length, segments):
+    # A .part file plus a sidecar recording what it is and how far each range got
+    part = {
+        'url': url,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'length': length,
+        'ranges': __accepts_ranges(r),
+        'segments': [[start, end, 0] for start, end in segments or [(0, length - 1)]]
+    }
+
+    # Preallocate the file so every range can be written in place
+    with open(path + '.part', 'wb') as f:
+        if length:
+            f.truncate(length)
+    __save_part(path, part)
+
+    return part
+
+def __load_part(path, r, length):
+    sidecar = path + '.part.json'
+    if not os.path.exists(path + '.part') or not os.path.exists(sidecar):
+        return None
+    try:
+        with open(sidecar) as f:
+            part = json.load(f)
+    except (OSError, ValueError):
+        logging.debug(" - Unreadable download sidecar, starting over: " + sidecar)
+        return None
+
+    # Only resume the same file - same length and the same ETag or Last-Modified
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    if not length or part.get('length') != length or os.path.getsize(path + '.part') != length:
+        return None
+    if not ((etag and part.get('etag') == etag) or (last_modified and part.get('last_modified') == last_modified)):
+        logging.debug(" - File changed on the server since the partial download, starting over")
+        return None
+    if not __accepts_ranges(r):
+        return None
+
+    return part
+
+def __save_part(path, part):
+    with this.part_lock:
+        with open(path + '.part.json.tmp', 'w') as f:
+            json.dump(part, f)
+        os.replace(path + '.part.json.tmp', path + '.part.json')
+
+def __save_open_parts():
+    with this.part_lock:
+        parts = list(this.open_parts.items())
+    for path, part in parts:
+        __save_part(path, part)
+
+def __terminated(signum, frame):
+    # finished patches are already in the status file - record the unfinished ones and stop
+    # without waiting for the download workers
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    __save_open_parts()
+    logging.error("Stopped by signal " + str(signum) + " - unfinished downloads will resume on the next run")
+    os._exit(128 + signum)
+
+def __download_part(session, r, path, part):
+    pending = [segment for segment in part['segments'] if segment[2] < segment[1] - segment[0] + 1 or segment[1] < 0]
+    digest = StreamDigest(path + '.part')
+    with this.part_lock:
+        this.open_parts[path] = part
+    try:
+        return __download_segments(session, r, path, part, pending, digest)
+    finally:
+        with this.part_lock:
+            this.open_parts.pop(path, None)
+
+def __download_segments(session, r, path, part, pending, digest):
+
+    # A full response (a server that ignored the probe's Range) is only kept when the file is
+    # one stream from the start - every range, the first included, gets its own Range request
+    parent = current_span()
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1), thread_name_prefix='segment') as pool:
+        ranges = []
+        for segment in pending:
+            download_range = __traced(parent, 'bytes ' + str(segment[0]) + '-' + str(segment[1]), __download_range, 'segment')
+            if r is not None and r.status_code == requests.codes.ok and len(part['segments']) == 1 and segment[2] == 0:
+                ranges.append(pool.submit(download_range, session, r.url, path, part, segment, digest, r))
+                r = None
+            else:
+                ranges.append(pool.submit(download_range, session, part['url'], path, part, segment, digest))
+        if r is not None:
+            r.close()
+        for result in ranges:
+            result.result()
+
+    digests = digest.hexdigests(part['segments'])
+    os.replace(path + '.part', path)
+    os.remove(path + '.part.json')
+    return digests
+
+def __download_range(session, url, path, part, segment, digest, r=None):
+    retries = int(this.config.get('download_retries') or 0)
+    attempt = 0
+    while True:
+        try:
+            if r is None:
+                r = __request_range(session, url, part, segment)
+            __write_range(path, part, segment, digest, r)
+            return
+        except RangeError:
+            raise
+        except (requests.exceptions.RequestException, IOError) as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logging.warning(" - Retrying download from byte " + str(segment[0] + segment[2]) + " after error: " + str(e))
+            count('download_retries')
+            r = None
+
+def __request_range(session, url, part, segment):
+    start, end, written = segment
+    if written and not part['ranges']:
+        # no way to pick up where we left off - start this file over
+        segment[2] = written = 0
+    if start + written == 0 and end == part['length'] - 1:
+        r = session.get(url, stream=True, allow_redirects=True)
+        if r.status_code != requests.codes.ok:
+            r.close()
+            raise IOError("Download returned " + str(r.status_code))
+        return r
+
+    # If-Range makes the server send the whole file if it changed underneath us
+    headers = {'Range': 'bytes=%d-%d' % (start + written, end)}
+    if part.get('etag') or part.get('last_modified'):
+        headers['If-Range'] = part.get('etag') or part.get('last_modified')
+    r = session.get(url, headers=headers, stream=True, allow_redirects=True)
+    content_range = r.headers.get('Content-Range', '')
+    if r.status_code != requests.codes.partial_content or not content_range.startswith('bytes %d-' % (start + written)):
+        r.close()
+        raise RangeError("Range request for bytes " + str(start + written) + "-" + str(end) + " returned " + str(r.status_code))
+
+    return r
+
+def __write_range(path, part, segment, digest, r):
+    start, end = segment[0], segment[1]
+    unsaved = 0
+    saved = time.perf_counter()
+    # unbuffered, so the digest can read back what other ranges have written
+    with open(path + '.part', 'r+b', buffering=0) as f:
+        f.seek(start + segment[2])
+        for data in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if end >= 0:
+                data = data[:end - start + 1 - segment[2]]
+            if this.rate_limiter:
+                this.rate_limiter.consume(len(data))
+            f.write(data)
+            add_span_bytes(len(data))
+            offset = start + segment[2]
+            segment[2] += len(data)
+            digest.update(offset, data, part['segments'])
+            unsaved += len(data)
+            if unsaved >= PART_SAVE_SIZE or time.perf_counter() - saved >= PART_SAVE_SECONDS:
+                __save_part(path, part)
+                unsaved = 0
+                saved = time.perf_counter()
+            if end >= 0 and segment[2] >= end - start + 1:
+                break
+    r.close()
+    __save_part(path, part)
+
+    if end >= 0 and segment[2] < end - start + 1:
+        raise IOError("Range " + str(start) + "-" + str(end) + " ended " + str(end - start + 1 - segment[2]) + " bytes early")
 
 # File Management Functions
-def __validate_input():
+def load_build_plan(src_yaml, platform=None, ptversion=None):
+    # Parse and validate the input YAML once - every problem is reported together.
+    # platform and ptversion, when given, replace the ones in the YAML
+    errors = []
 
-    with open(os.path.join(os.getcwd(), 'codes', 'codes.yaml')) as c:
-        this.codes = yaml.load(c, Loader=yaml.FullLoader)
+    codes_file = __find_codes_yaml()
+    try:
+        with open(codes_file) as c:
+            codes = yaml.load(c, Loader=yaml.FullLoader) or {}
+    except (OSError, yaml.YAMLError) as e:
+        logging.error("Unable to read release codes from " + codes_file + ": " + str(e))
+        exit(2)
 
-    with open(this.config.get('src_yaml'), 'r') as f:
-        yml = yaml.load(f, Loader=yaml.FullLoader)
-        logging.debug(json.dumps(yml, indent=2))
+    try:
+        with open(src_yaml, 'r') as f:
+            yml = yaml.load(f, Loader=yaml.FullLoader)
+    except OSError:
+        logging.error("Source YAML File not found: " + src_yaml)
+        exit(2)
+    except yaml.YAMLError as e:
+        logging.error("Source YAML File is not valid YAML: " + str(e))
+        exit(2)
+    if not isinstance(yml, dict):
+        logging.error("Source YAML File must contain a mapping of sections: " + src_yaml)
+        exit(2)
 
     # Validate input file has required sections
-    try:
-        platform_name = yml.get('platform')
-        this.config['platform'] = platform_name
-        if platform_name:
-            platform = this.codes['platform'][yml['platform']]
-            logging.debug("Platform - " + yml['platform'] + ": " + platform)
-        else:
-            logging.error("Input YAML file must specify 'platform: <value>'")
-        ptversion = yml.get(PEOPLETOOLS)
-        this.config['ptversion'] = ptversion
-        if ptversion:
-            logging.debug("Download patches for PeopleTools " + ptversion)
-        else:
-            logging.error("Input YAML file must specify 'peopletools: <value>'")
-    except:
+    platform = platform or yml.get('platform')
+    platform_code = None
+    if not platform:
+        errors.append("Input YAML file must specify 'platform: <value>'")
+    elif platform not in codes.get('platform', {}):
+        errors.append("Unknown platform '" + str(platform) + "' - expected one of " + ", ".join(codes.get('platform', {})))
+    else:
+        platform_code = codes['platform'][platform]
+
+    ptversion = ptversion or yml.get(PEOPLETOOLS)
+    releases = {}
+    if not ptversion:
+        errors.append("Input YAML file must specify 'peopletools: <value>'")
+    elif str(ptversion) not in codes.get(PEOPLETOOLS, {}):
+        errors.append("Unknown PeopleTools version '" + str(ptversion) + "' - expected one of " + ", ".join(codes.get(PEOPLETOOLS, {})))
+    else:
+        releases = codes[PEOPLETOOLS][str(ptversion)]
+
+    sections = []
+    for name, product, versioned in SECTIONS:
+        if not yml.get(name):
+            continue
+        if not isinstance(yml[name], list):
+            errors.append("Section '" + name + "' must be a list of patches")
+            continue
+        release = releases.get(name)
+        if ptversion and releases and not release:
+            errors.append("No " + name + " release code for PeopleTools " + str(ptversion) + " in " + codes_file)
+
+        patches = []
+        for index, entry in enumerate(yml[name], start=1):
+            number, _, version = str(entry).partition(':')
+            if not re.match(r"^\d+$", number):
+                errors.append(name + " patch" + str(index) + ": '" + str(entry) + "' is not a patch number")
+            if versioned and not version:
+                errors.append(name + " patch" + str(index) + ": '" + str(entry) + "' needs a version - use 'patchid:version'")
+            # JDK patches are searched by their own version, not the release code
+            patches.append(PlanPatch(index, number, version or None, version if name == JDK else release))
+        sections.append(PlanSection(name, product, release, patches))
+
+    manifest = yml.get('manifest') or {}
+    if not isinstance(manifest, dict):
+        errors.append("Section 'manifest' must be a mapping of key: value pairs")
+
+    if errors:
+        for error in errors:
+            logging.error(error)
         exit(2)
 
-    return yml, ptversion, platform
+    plan = BuildPlan(src_yaml, platform, platform_code, str(ptversion), sections, manifest)
+    logging.debug("Build plan: " + repr(plan))
+    return plan
+
+def __find_codes_yaml():
+    # config.json wins, then ./codes (the old location), then the codes next to byop
+    if this.config.get(CODES):
+        return this.config.get(CODES)
+    local_codes = os.path.join(os.getcwd(), 'codes', 'codes.yaml')
+    if os.path.exists(local_codes):
+        return local_codes
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codes', 'codes.yaml')
 
 def __create_patch_status():
-    if not os.path.exists(this.config.get(STATUS)):
-        logging.debug("Patch Status File missing - creating it now")
+    # Load the status store once - workers read and update it in memory
+    with this.status_lock:
+        this.patch_status = {'version': STATUS_VERSION, 'patches': {}}
+        if os.path.exists(this.config.get(STATUS)):
+            try:
+                with open(this.config.get(STATUS)) as f:
+                    patch_status = json.load(f)
+            except:
+                logging.error("Issue opening Patch status file")
+                raise
+            if patch_status.get('version') == STATUS_VERSION:
+                this.patch_status = patch_status
+            else:
+                logging.info("Patch status file is from an older version of byop - patches will be checked again")
+        else:
+            logging.debug("Patch Status File missing - creating it now")
+
+    __flush_patch_status(force=True)
+
+def __patch_status_key(patch, platform, release, product):
+    return '|'.join([str(product), str(platform), str(release), str(patch)])
+
+def __get_patch_status(patch, platform, release, product):
+    # Checking Patch download status
+    if this.config.get('redownload'):
+        logging.debug("Redownload Flag is set - skipping check of patch status")
+        return None
+    if this.patch_status is None:
+        __create_patch_status()
+
+    with this.status_lock:
+        status = this.patch_status['patches'].get(__patch_status_key(patch, platform, release, product))
+    if not status or not status.get('downloaded'):
+        return None
+
+    # A patch only counts when its files are still in cpu_archives
+    for file in status.get('files', []):
+        path = os.path.join(this.config[ARCHIVE], product, file['name'])
+        if not os.path.exists(path) or os.path.getsize(path) != file.get('size'):
+            logging.debug("Patch status for " + str(patch) + " is stale - " + file['name'] + " is missing or changed")
+            return None
+    return status
+
+def __update_patch_status(patch, platform, release, product, files):
+    if this.patch_status is None:
+        __create_patch_status()
+
+    with this.status_lock:
+        this.patch_status['patches'][__patch_status_key(patch, platform, release, product)] = {
+            'patch': str(patch),
+            'platform': platform,
+            'release': release,
+            'product': product,
+            'downloaded': True,
+            'files': files,
+            'updated': datetime.datetime.now().isoformat(timespec='seconds')
+        }
+        this.status_dirty = True
+
+    # a finished patch is written straight away - if byop is killed now, the next run
+    # must not download it again
+    __flush_patch_status()
+
+def __flush_patch_status(force=False):
+    # The file is replaced atomically, and only when something changed
+    with this.status_lock:
+        if this.patch_status is None or not (force or this.status_dirty):
+            return
         try:
-            with open(this.config.get(STATUS),'w') as f:
-                patch_status = {}
-                json.dump(patch_status, f)
+            with open(this.config.get(STATUS) + '.tmp', 'w') as f:
+                json.dump(this.patch_status, f, indent=2, sort_keys=True)
+            os.replace(this.config.get(STATUS) + '.tmp', this.config.get(STATUS))
+            this.status_dirty = False
         except FileNotFoundError:
             logging.error("Patch status file not created. Try again with `byop config`")
             exit(2)
-        except:
-            logging.error("Issue creating Patch status file")
-            raise
-
-def __get_patch_status(patch):
-    # Checking Patch download status
-    if not this.config.get('redownload'):
-        if not os.path.exists(this.config.get(STATUS)):
-            __create_patch_status()
-        try:
-            with open(this.config.get(STATUS)) as f:
-                patch_status = json.load(f)
-        except:
-            logging.error("Issue opening Patch status file")
-
-        logging.debug("Patch status: \n" + json.dumps(patch_status))
-        try:
-            if patch_status[str(patch)]:
-                return True
-        except:
-            return False
-    else:
-        logging.debug("Redownload Flag is set - skipping check of patch status")
-        pass
-
-def __update_patch_status(step, status):
-    try:
-        with open(this.config.get(STATUS), 'r+') as f:
-            patch_status = json.load(f)
-            patch_status[step] = status
-            f.seek(0)
-            f.truncate()
-            json.dump(patch_status, f, indent=2)
-    except:
-        logging.error('Issue updating patch status json file')
-
-def __write_to_yaml(dict, header):
+        except OSError:
+            logging.error('Issue updating patch status json file')
 
+def __load_target_yaml():
+    # Read the existing target YAML once - sections are merged into it in memory
     if os.path.exists(this.config.get('tgt_yaml')):
         with open(this.config.get('tgt_yaml'), 'r') as tgt_yaml:
-            tgt = yaml.load(tgt_yaml, Loader=yaml.FullLoader) or {}
+            this.target_yaml = yaml.load(tgt_yaml, Loader=yaml.FullLoader) or {}
     else:
-        tgt = {}
+        this.target_yaml = {}
 
-    tgt.pop(header, None)
-    tgt[header] = dict
-    
-    with open(this.config.get('tgt_yaml'), 'w') as tgt_yaml:
-        yaml.dump(tgt, tgt_yaml, sort_keys=True, indent=2)
-
-def __convert_jdk_archive(file, release):
-
-    zip_file = os.path.join(this.config.get(TEMP), file)
+def __write_to_yaml(dict, header):
+    # sections finish on their own threads - one writer at a time
+    with this.yaml_lock:
+        if this.target_yaml is None:
+            __load_target_yaml()
+        this.target_yaml.pop(header, None)
+        this.target_yaml[header] = dict
+
+def __save_target_yaml():
+    # Written once, to a temp file that replaces the target in one step
+    if this.target_yaml is None:
+        return
+    with this.yaml_lock:
+        with open(this.config.get('tgt_yaml') + '.tmp', 'w') as tgt_yaml:
+            yaml.dump(this.target_yaml, tgt_yaml, sort_keys=True, indent=2)
+        os.replace(this.config.get('tgt_yaml') + '.tmp', this.config.get('tgt_yaml'))
+    logging.debug("Wrote " + this.config.get('tgt_yaml'))
+
+def __convert_jdk_archive(file, release, platform):
+    # Stream the delivered JDK straight into the DPK tarball - nothing is extracted to disk.
+    # The JDK archives have an extra top directory that breaks with the DPK, so it is dropped from every member name.
+    zip_file = __stored_file(file) or os.path.join(this.config.get(TEMP), file)
     logging.debug("Zip file: " + str(zip_file))
-    
-    if this.config.get('platform') == 'linux':
-        tarfile_orig =  os.path.join(this.config.get(TEMP), 'jdk-' + release + '_linux-x64_bin.tar.gz')
-        logging.debug("Delivered Tarball: " + str(tarfile_orig))
-    elif this.config.get('platform') == 'windows':
-        tarfile_orig =  os.path.join(this.config.get(TEMP), 'jdk-' + release + '_windows-x64_bin.zip')
-        logging.debug("Delivered Tarball: " + str(tarfile_orig))
 
+    if platform == 'linux':
+        archive_orig = 'jdk-' + release + '_linux-x64_bin.tar.gz'
+    elif platform == 'windows':
+        archive_orig = 'jdk-' + release + '_windows-x64_bin.zip'
+    logging.debug("Delivered Tarball: " + archive_orig)
 
     tarfile_pt = os.path.join(this.config.get(TEMP), 'pt-jdk-' + release + '.tgz')
-    tarfile_dir = os.path.join(this.config.get(TEMP), 'tar')
-    try:
-        os.makedirs(tarfile_dir, exist_ok = True)
-    except OSError as error:
-        logging.error("Directory '%s' can not be created" % tarfile_dir)
-    
-    # Extract the .zip
-    logging.debug("  - JDK - unzipping download")
-    with zipfile.ZipFile(zip_file) as zipf:
-        zipf.extractall(this.config[TEMP])
-
-    if this.config.get('platform') == 'linux':
-        # Extract the .tar.gz file - it contains an extra top directory that breaks with the DPK
-        if (os.path.exists(tarfile_orig)):
-            logging.debug("Cleanup tmp/tar directory before re-extracting JDK tarball")
-            # JDK tar permissions cause errors when cleanup is run - change them before?
-            files = glob.glob(config.get(TEMP) + "/tar/*", recursive=True)
-            if files:
-                for f in files:
-                    try:
-                        shutil.rmtree(f)
-                        logging.debug("Removed file: " + str(f))
-                    except OSError as e:
-                        logging.error("Error: %s : %s" % (f, e.strerror))
-            logging.debug("  - JDK - untarring .tar.gz file to remove parent directory")
-            tar1 = tarfile.open(tarfile_orig)
-            tar1.extractall(path=tarfile_dir) #, set_attrs=False)
-            tar1.close
-        else:
-            logging.error("No tarball matching filename found: " + tarfile_orig)
-    elif this.config.get('platform') == 'windows':
-        # Extract the .zip
-        logging.debug("  - JDK - unzipping download")
-        with zipfile.ZipFile(tarfile_orig) as zipf:
-            zipf.extractall(tarfile_dir)
-
-    # Repackage the tarball and rename for the DPK
-    logging.debug("  - JDK - creating DPK compatible .tgz")
-    logging.debug("  - Source: " + str(tarfile_dir))
-    file = __tardirectory(tarfile_dir, tarfile_pt)
-    logging.debug("DPK Compatible JDK Archive: " + os.path.basename(file))
-
-    shutil.rmtree(tarfile_dir)
-    return os.path.basename(file)
-
-def __tardirectory(path, name):
-    original_dir = os.getcwd()
-    top_level_folder = next(os.walk(path))[1][0]
-    os.chdir(os.path.join(path, top_level_folder))
-    logging.debug("Top Level Folder Name: " + top_level_folder)
-
-    with tarfile.open(name, "w:gz") as tarhandle:
-        for root, dirs, files in os.walk(os.getcwd()):
-            for file in files:
-                tarhandle.add(os.path.relpath(os.path.join(root, file)))
-
-    os.chdir(original_dir)
-    return name
-
-def __zipdirectory(filename, folders):
-    with zipfile.ZipFile(os.path.join(this.config.get(OUTPUT), filename),'a') as zip:
-    
-        original_dir = os.getcwd()
-        os.chdir(this.config.get(OUTPUT))
-        for folder in folders:
-            path = os.path.join(os.path.basename(this.config.get(ARCHIVE)), folder)
-
-            logging.debug("Zip path: " + path)
-            logging.debug("Zip file: " + str(zip))
-            for dirname, subdirs, files in os.walk(path):
-                zip.write(dirname)
-                for filename in files:
-                    zip.write(os.path.join(dirname, filename))
+    tarfile_tmp = tarfile_pt + '.tmp'
 
-    os.chdir(original_dir)
-
-def __zipyaml(filename, file):
-    with zipfile.ZipFile(os.path.join(this.config.get(OUTPUT), filename),'a') as zip:
-        original_dir = os.getcwd()
-        os.chdir(this.config.get(OUTPUT))
-        logging.info("Adding " + file + " to zip")
-        zip.write(os.path.join(file))
+    with zipfile.ZipFile(zip_file) as zipf:
+        names = zipf.namelist()
+        if archive_orig not in names:
+            # fall back to any JDK bundle in the download if Oracle changes the file name
+            bundles = [n for n in names if re.match(r"^jdk-.*\.(tar\.gz|zip)$", os.path.basename(n))]
+            if not bundles:
+                logging.error("No tarball matching filename found: " + archive_orig)
+                return None
+            archive_orig = bundles[0]
+            logging.debug("Using JDK bundle: " + archive_orig)
+
+        logging.debug("  - JDK - streaming " + archive_orig + " to DPK compatible .tgz")
+        with zipf.open(archive_orig) as bundle, open(tarfile_tmp, 'wb') as tgz, \
+                ParallelGzipWriter(tgz, this.config.get('gzip_level'), this.config.get('gzip_threads')) as gz, \
+                tarfile.open(fileobj=gz, mode='w') as tarhandle:
+            if archive_orig.endswith('.tar.gz'):
+                __retar_jdk_tarball(bundle, tarhandle)
+            else:
+                __retar_jdk_zip(bundle, tarhandle)
+    os.replace(tarfile_tmp, tarfile_pt)
+
+    logging.debug("DPK Compatible JDK Archive: " + os.path.basename(tarfile_pt))
+    return os.path.basename(tarfile_pt)
+
+def __strip_top_folder(name):
+    if name.startswith('./'):
+        name = name[2:]
+    return name.partition('/')[2].rstrip('/')
+
+def __retar_jdk_tarball(bundle, tarhandle):
+    # 'r|gz' reads the tarball as a stream, so each member is copied as it is decompressed
+    with tarfile.open(fileobj=bundle, mode='r|gz') as source:
+        for member in source:
+            member.name = __strip_top_folder(member.name)
+            if not member.name:
+                continue
+            if member.islnk():
+                member.linkname = __strip_top_folder(member.linkname)
+            if member.isreg():
+                tarhandle.addfile(member, source.extractfile(member))
+            else:
+                tarhandle.addfile(member)
+
+def __retar_jdk_zip(bundle, tarhandle):
+    # zipfile needs to seek to the central directory - Python < 3.7 can't seek inside a zip member
+    if not bundle.seekable():
+        spool = tempfile.TemporaryFile(dir=this.config.get(TEMP))
+        shutil.copyfileobj(bundle, spool, DOWNLOAD_CHUNK_SIZE)
+        spool.seek(0)
+        bundle = spool
+    with zipfile.ZipFile(bundle) as source:
+        for info in source.infolist():
+            member = tarfile.TarInfo(__strip_top_folder(info.filename))
+            if not member.name:
+                continue
+            member.mtime = time.mktime(info.date_time + (0, 0, -1))
+            member.mode = 0o755 if info.is_dir() else 0o644
+            if info.is_dir():
+                member.type = tarfile.DIRTYPE
+                tarhandle.addfile(member)
+            else:
+                member.size = info.file_size
+                with source.open(info) as data:
+                    tarhandle.addfile(member, data)
+
+def __zipvolume(zip_path, entries):
+    # Refresh a volume in place - members that still match cpu_archives are left untouched and
+    # only what changed after them is written, so re-running zip never duplicates entries
+    name = os.path.basename(zip_path)
+    kept, existing = __zip_unchanged(zip_path, entries)
+    if kept and len(kept) == existing == len(entries):
+        logging.info(name + " is up to date")
+        return zip_path
+
+    with __open_volume(zip_path, len(kept)) as zip:
+        kept = set(zip.namelist())
+        logging.debug(name + ": keeping " + str(len(kept)) + " of " + str(existing) + " members, writing " + str(len(entries) - len(kept)))
+        for arcname, path in entries:
+            if arcname not in kept:
+                logging.debug("Adding " + arcname + " to " + name)
+                __zip_write(zip, path, arcname)
+                add_span_bytes(os.path.getsize(path))
+    logging.info(("Updated " if existing else "Created ") + name + " (" + str(len(entries)) + " entries, " + 
+                 str(round(os.path.getsize(zip_path) / 1024 / 1024)) + " MB)")
+
+    return zip_path
+
+def __zip_basename(plan):
+    now = datetime.datetime.now()
+    date = now.strftime("%y%m%d")
+    return 'PT-INFRA-DPK-' + plan.platform_short + '-' + plan.tools_version + '-' + date
+
+def __zip_paths(archive_dir, basename):
+    volumes = int(this.config.get('zip_volumes') or 2)
+    zip_paths = []
+    for zipno in range(1, volumes + 1):
+        zipname = basename + '_' + str(zipno) + 'of' + str(volumes) + '.zip'
+        logging.debug("Infra-DPK zip file name: " + zipname)
+        zip_paths.append(os.path.join(archive_dir, zipname))
+    return zip_paths
+
+# Packager - streams patches into the volumes during the build; create_zip_file finishes them
+def __start_packager(zip_paths):
+    os.makedirs(os.path.dirname(zip_paths[0]) or '.', exist_ok=True)
+    this.packager = {
+        'zip_paths': zip_paths,
+        'queue': queue.Queue(maxsize=PACKAGER_QUEUE_SIZE),
+        'error': None
+    }
+    this.packager['thread'] = threading.Thread(target=__run_packager, args=(this.packager,), name='packager', daemon=True)
+    this.packager['thread'].start()
+
+def __package_file(product, file):
+    # Hand a finished file to the packager - blocks while the packager is behind
+    if this.packager:
+        arcname = os.path.basename(this.config[ARCHIVE]) + '/' + product + '/' + file
+        this.packager['queue'].put((arcname, os.path.join(this.config[ARCHIVE], product, file)))
+
+def __finish_packager():
+    packager = this.packager
+    if not packager:
+        return
+    packager['queue'].put(None)
+    packager['thread'].join()
+    this.packager = None
+    if packager['error']:
+        logging.warning("Packaging during the build failed, the zip files will be refreshed from cpu_archives: " + str(packager['error']))
+
+def __run_packager(packager):
+    # One writer for every volume. Each file goes to the volume that already has it or the lightest one.
+    # A volume is only opened - cut back to the patches that are still current, dropping the YAML and
+    # manifest that create_zip_file adds last - when the first file it doesn't hold arrives, so a build
+    # that brings nothing new leaves the volumes alone.
+    volumes = [None] * len(packager['zip_paths'])
+    try:
+        folders, files = __archive_contents()
+        entries = folders + [(arcname, path) for arcname, path, size in files]
+        keeps = []
+        members = []
+        loads = []
+        for zip_path in packager['zip_paths']:
+            kept, existing = __zip_unchanged(zip_path, entries)
+            infos = []
+            if existing:
+                with zipfile.ZipFile(zip_path) as zip:
+                    infos = zip.infolist()
+            keeps.append(len(kept))
+            members.append({info.filename: info for info in infos})
+            loads.append(sum(info.file_size for info in infos))
+
+        while True:
+            item = packager['queue'].get()
+            if item is None:
+                break
+            arcname, path = item
+            index = next((i for i in range(len(members)) if arcname in members[i]), None)
+            if index is not None and __zip_member_current(members[index][arcname], path):
+                continue
+            if index is None:
+                index = loads.index(min(loads))
+
+            zip = volumes[index]
+            if zip is None:
+                zip = volumes[index] = __open_volume(packager['zip_paths'][index], keeps[index])
+                members[index] = {info.filename: info for info in zip.infolist()}
+                loads[index] = sum(info.file_size for info in zip.infolist())
+            arcdir = arcname.rsplit('/', 1)[0] + '/'
+            with timed('package ' + arcname.rsplit('/', 1)[1], 'zip'):
+                if arcdir not in members[index]:
+                    __zip_write(zip, os.path.dirname(path), arcdir)
+                    members[index][arcdir] = zip.getinfo(arcdir)
+                __zip_write(zip, path, arcname)
+                members[index][arcname] = zip.getinfo(arcname)
+                add_span_bytes(members[index][arcname].file_size)
+            loads[index] += members[index][arcname].file_size
+            logging.debug("Packaged " + arcname + " into " + os.path.basename(packager['zip_paths'][index]))
+    except Exception as e:
+        packager['error'] = e
+        # keep taking files so the build never blocks on a full queue
+        while packager['queue'].get() is not None:
+            pass
+    finally:
+        for zip in volumes:
+            if zip is None:
+                continue
+            try:
+                if packager['error']:
+                    zip.discard()
+                else:
+                    zip.close()
+            except Exception as e:
+                packager['error'] = packager['error'] or e
+
+def __write_checksums(pool, checksum_file, zip_paths, files):
+    # sha256sum format - check the zip files where they are, and the patches once the zips are extracted
+    recorded = __recorded_digests()
+    lines = []
+    digests = list(pool.map(__sha256, zip_paths))
+    for index, zip_path in enumerate(zip_paths):
+        lines.append(digests[index] + '  ' + os.path.basename(zip_path))
+    for arcname, path, size in files:
+        product, name = path.split(os.sep)[-2:]
+        digest = recorded.get((product, name, size)) or __sha256(path)
+        lines.append(digest + '  ' + arcname)
+
+    with open(checksum_file + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(checksum_file + '.tmp', checksum_file)
+    logging.info("Created " + os.path.basename(checksum_file))
+
+def __recorded_digests():
+    # SHA-256 of every file in the status store, so zip doesn't have to read the patches again
+    patch_status = this.patch_status
+    if patch_status is None:
+        try:
+            with open(this.config.get(STATUS)) as f:
+                patch_status = json.load(f)
+        except (OSError, ValueError):
+            patch_status = {}
+
+    recorded = {}
+    for status in (patch_status.get('patches') or {}).values():
+        for file in status.get('files', []):
+            if file.get('sha256'):
+                recorded[(status['product'], file['name'], file.get('size'))] = file['sha256']
+    return recorded
+
+def __zip_write(zip, path, arcname):
+    # Stream the file in large chunks; file_size is set from the file, so zipfile writes ZIP64 headers up front for anything near 4 GB
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    if info.is_dir():
+        zip.writestr(info, b'')
+        return
+    with open(path, 'rb') as src, zip.open(info, 'w') as dest:
+        shutil.copyfileobj(src, dest, DOWNLOAD_CHUNK_SIZE)
+
+def __archive_contents():
+    # Product folders and patch files under cpu_archives, as (archive name, path, size).
+    # Archive names are relative to the output directory, e.g. cpu_archives/jdk_patches/pt-jdk-11.0.17.tgz
+    archive = os.path.basename(this.config.get(ARCHIVE))
+    folders = []
+    files = []
+    for section, product, versioned in SECTIONS:
+        path = os.path.join(this.config.get(ARCHIVE), product)
+        for dirname, subdirs, filenames in os.walk(path):
+            subdirs.sort()
+            arcdir = archive + '/' + os.path.relpath(dirname, this.config.get(ARCHIVE)).replace(os.sep, '/') + '/'
+            folders.append((arcdir, dirname))
+            for filename in sorted(filenames):
+                file = os.path.join(dirname, filename)
+                files.append((arcdir + filename, file, os.path.getsize(file)))
+    return folders, files
+
+def __assign_volumes(files, zip_paths):
+    # Balance patch files across the volumes by size (largest first onto the lightest volume).
+    # Files already in an existing volume stay where they are, so a refresh only appends.
+    assigned = [[] for zip_path in zip_paths]
+    loads = [0] * len(zip_paths)
+    sizes = {arcname: (path, size) for arcname, path, size in files}
+
+    for index, zip_path in enumerate(zip_paths):
+        try:
+            with zipfile.ZipFile(zip_path) as zip:
+                names = zip.namelist()
+        except (OSError, zipfile.BadZipFile):
+            continue
+        for name in names:
+            if name in sizes:
+                path, size = sizes.pop(name)
+                assigned[index].append((name, path))
+                loads[index] += size
+
+    for arcname, (path, size) in sorted(sizes.items(), key=lambda file: (-file[1][1], file[0])):
+        index = loads.index(min(loads))
+        assigned[index].append((arcname, path))
+        loads[index] += size
+
+    for index, zip_path in enumerate(zip_paths):
+        logging.debug(os.path.basename(zip_path) + ": " + str(round(loads[index] / 1024 / 1024)) + " MB of patches")
+    return assigned
+
+def __zip_entries(folders, files, empty, extras):
+    # Everything a volume should hold, in archive order: the folders its patches are in,
+    # its patch files, then files from the output directory
+    entries = []
+    for arcdir, dirname in folders:
+        if (arcdir, dirname) in empty or any(arcname.startswith(arcdir) for arcname, path in files):
+            entries.append((arcdir, dirname))
+    entries.extend(sorted(files))
+
+    for file in extras:
+        path = os.path.join(this.config.get(OUTPUT), file)
+        if not os.path.exists(path):
+            logging.warning(file + " not found - not added to zip")
+            continue
+        entries.append((file, path))
+    return entries
+
+def __zip_unchanged(zip_path, entries):
+    # Names of the leading members of an existing volume that are still current, and how many members it has
+    if not os.path.exists(zip_path):
+        return [], 0
+    try:
+        with zipfile.ZipFile(zip_path) as zip:
+            members = zip.infolist()
+    except zipfile.BadZipFile:
+        logging.warning(os.path.basename(zip_path) + " is not a valid zip file - rebuilding it")
+        return [], 0
+
+    wanted = dict(entries)
+    kept = []
+    for info in members:
+        path = wanted.get(info.filename)
+        if path is None or info.filename in kept or not __zip_member_current(info, path):
+            break
+        kept.append(info.filename)
+    return kept, len(members)
+
+def __zip_member_current(info, path):
+    if info.is_dir():
+        return os.path.isdir(path)
+    if not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+        return False
+    if zipfile.ZipInfo.from_file(path).date_time == info.date_time:
+        return True
+    # same size, new timestamp - the manifest and YAML are rewritten by every build, often unchanged
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+def __open_volume(zip_path, keep):
+    # A volume ready for new members, holding the first keep members of the existing one
+    if keep and __cut_volume(zip_path, keep):
+        return ZipVolume(zip_path, append=True)
+    return ZipVolume(zip_path)
+
+def __cut_volume(zip_path, keep):
+    # zipfile can't remove members, so the stale ones are cut off the end of the file: it is truncated
+    # at the first stale member and the kept members' central directory records are written back
+    # after them. The kept members are not read or copied. False if the layout doesn't allow it.
+    with zipfile.ZipFile(zip_path) as zip:
+        members = zip.infolist()
+    if keep >= len(members):
+        return True
+    offsets = [info.header_offset for info in members]
+    if offsets != sorted(offsets):
+        return False
+    cut = offsets[keep]
 
-    os.chdir(original_dir)
+    with open(zip_path, 'r+b') as f:
+        cd_offset = __central_directory_offset(f)
+        if cd_offset is None:
+            return False
+        f.seek(cd_offset)
+        records = []
+        for index in range(keep):
+            header = f.read(46)
+            if len(header) < 46 or header[:4] != b'PK\x01\x02':
+                return False
+            name, extra, comment = struct.unpack('<3H', header[28:34])
+            records.append(header + f.read(name + extra + comment))
+        records = b''.join(records)
+
+        f.seek(cut)
+        f.truncate()
+        f.write(records)
+        count, size, offset = keep, len(records), cut
+        if count >= 0xFFFF or size > zipfile.ZIP64_LIMIT or offset > zipfile.ZIP64_LIMIT:
+            f.write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, size, offset))
+            f.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, offset + size, 1))
+            count, size, offset = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(offset, 0xFFFFFFFF)
+        f.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count, size, offset, 0))
+    return True
+
+def __central_directory_offset(f):
+    # From the end of central directory record, or its ZIP64 version
+    f.seek(0, os.SEEK_END)
+    length = f.tell()
+    f.seek(max(length - 22 - 65535, 0))
+    tail = f.read()
+    end = tail.rfind(b'PK\x05\x06')
+    if end < 0 or end + 22 > len(tail):
+        return None
+    offset = struct.unpack('<L', tail[end + 16:end + 20])[0]
+    if offset == 0xFFFFFFFF and end >= 20 and tail[end - 20:end - 16] == b'PK\x06\x07':
+        f.seek(struct.unpack('<Q', tail[end - 12:end - 4])[0])
+        record = f.read(56)
+        if record[:4] != b'PK\x06\x06':
+            return None
+        offset = struct.unpack('<Q', record[48:56])[0]
+    return offset
+
+def __format_bytes(amount, seconds):
+    rate = amount / seconds if seconds > 0 else 0
+    return "  {:>9.1f} MB {:>7.1f} MB/s".format(amount / 1024 / 1024, rate / 1024 / 1024)
 
 # Logging and Timings
-def setup_logging():
+def setup_logging(prefix=''):
 
     if this.config.get("verbose") == True:
         loglevel=logging.DEBUG
@@ -1001,31 +2974,331 @@ def setup_logging():
     rootLogger.setLevel(loglevel)
 
     fileHandler = logging.FileHandler('{0}'.format('byop.log'), mode='a')
-    fileFormatter = logging.Formatter('%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s')
+    fileFormatter = logging.Formatter('%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  ' + prefix + '%(message)s')
     fileHandler.setFormatter(fileFormatter)
     fileHandler.setLevel(loglevel)
     rootLogger.addHandler(fileHandler)
 
     consoleHandler = logging.StreamHandler()
-    consoleFormatter = logging.Formatter('[%(levelname)-5.5s]  %(message)s')
+    consoleFormatter = logging.Formatter('[%(levelname)-5.5s]  ' + prefix + '%(message)s')
     consoleHandler.setFormatter(consoleFormatter)
     consoleHandler.setLevel(loglevel)
     rootLogger.addHandler(consoleHandler)
 
     logging.debug('Debug Log File: byop.log')
 
-def init_timings():
+def init_timings(command=None):
     this.timings = {}
     this.timings[this.total_time_key] = datetime.datetime.now()
+    with this.span_lock:
+        this.spans = []
+        this.timing_spans = {}
+        this.patch_spans = []
+    with this.counter_lock:
+        this.counters = collections.Counter()
+    context = click.get_current_context(silent=True)
+    this.root_span = None
+    this.root_span = start_span('byop ' + (command or (context.info_name if context else '')), 'command')
 
 def start_timing(name):
     this.timings[name] = datetime.datetime.now()
+    span = start_span(name, 'timing')
+    __span_stack().append(span)
+    this.timing_spans[name] = span
 
 def end_timing(name):
     # if timing duration has been calculated, skip
     if not isinstance(this.timings[name], datetime.timedelta):
         start_time = this.timings[name]
         this.timings[name] = datetime.datetime.now() - start_time
+        span = this.timing_spans.get(name)
+        if span:
+            stack = __span_stack()
+            if span in stack:
+                stack.remove(span)
+            end_span(span)
+
+# Spans - the parent is the innermost span open on this thread, unless work is handed to another thread
+def start_span(name, category, parent=None):
+    span = Span(name, category, parent or current_span())
+    with this.span_lock:
+        this.spans.append(span)
+    return span
+
+def end_span(span):
+    if span.end is None:
+        span.end = time.perf_counter()
+
+def current_span():
+    stack = __span_stack()
+    return stack[-1] if stack else this.root_span
+
+@contextlib.contextmanager
+def timed(name, category='', parent=None):
+    span = start_span(name, category, parent)
+    stack = __span_stack()
+    stack.append(span)
+    try:
+        yield span
+    finally:
+        stack.pop()
+        end_span(span)
+
+def add_span_bytes(amount):
+    # bytes go on the innermost span; parents report the total of their children
+    span = current_span()
+    if span:
+        span.bytes += amount
+
+def __span_stack():
+    if not hasattr(this.span_stack, 'spans'):
+        this.span_stack.spans = []
+    return this.span_stack.spans
+
+def __traced(parent, name, fn, category='stage'):
+    # fn, run inside a span under parent on whichever thread picks it up
+    def run(*args):
+        with timed(name, category, parent):
+            return fn(*args)
+    return run
+
+def __span_totals():
+    # bytes per span including everything below it
+    totals = {}
+    with this.span_lock:
+        spans = list(this.spans)
+    for span in spans:
+        node = span
+        while node:
+            totals[node.id] = totals.get(node.id, 0) + span.bytes
+            node = node.parent
+    return spans, totals
+
+def write_trace(path):
+    # One file for both readers: the span tree under "byop" and Chrome trace events under "traceEvents"
+    if not path or not this.root_span:
+        return
+    end_span(this.root_span)
+    spans, totals = __span_totals()
+    origin = this.root_span.start
+    pid = os.getpid()
+
+    nodes = {}
+    tree = []
+    events = []
+    threads = {}
+    for span in spans:
+        duration = span.duration()
+        node = {
+            'name': span.name,
+            'category': span.category,
+            'thread': span.thread.name,
+            'start': round(span.start - origin, 6),
+            'duration': round(duration, 6),
+            'bytes': totals.get(span.id, 0),
+            'throughput': round(totals.get(span.id, 0) / duration) if duration > 0 else 0,
+            'children': []
+        }
+        nodes[span.id] = node
+        if span.parent and span.parent.id in nodes:
+            nodes[span.parent.id]['children'].append(node)
+        else:
+            tree.append(node)
+
+        event = {'name': span.name, 'cat': span.category or 'byop', 'pid': pid, 'tid': span.thread.ident,
+                 'ts': round((span.start - origin) * 1e6), 
+                 'args': {'bytes': node['bytes'], 'throughput': node['throughput'], 'parent': span.parent.name if span.parent else None}}
+        threads[span.thread.ident] = span.thread.name
+        if span.category == 'patch':
+            # patches move between threads, so they are drawn as async spans
+            events.append(dict(event, ph='b', id=span.id))
+            events.append({'name': span.name, 'cat': event['cat'], 'pid': pid, 'tid': span.thread.ident, 'ph': 'e', 'id': span.id,
+                           'ts': round((span.start - origin + duration) * 1e6)})
+        else:
+            events.append(dict(event, ph='X', dur=round(duration * 1e6)))
+    for ident, name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ident, 'args': {'name': name}})
+
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms', 'byop': tree}
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(trace, f, indent=1)
+        os.replace(path + '.tmp', path)
+        logging.info("Trace written to " + path)
+    except OSError as e:
+        logging.warning("Could not write trace file " + path + ": " + str(e))
+
+def count(name, amount=1):
+    with this.counter_lock:
+        this.counters[name] += amount
+
+def write_metrics(path, plan=None):
+    # OpenMetrics text for a node_exporter textfile collector - every value describes the last run
+    path = path or this.config.get('metrics_file')
+    if not path or not this.root_span:
+        return
+    end_span(this.root_span)
+    spans, totals = __span_totals()
+    labels = {}
+    if plan:
+        labels = {'platform': plan.platform, 'peopletools': plan.tools_version}
+    command = this.root_span.name.split(' ', 1)[-1]
+
+    families = collections.OrderedDict()
+    def add(name, kind, unit, help, value, **extra):
+        family = families.setdefault(name, (kind, unit, help, []))
+        family[3].append((dict(labels, **extra), value))
+
+    add('byop_last_run_timestamp_seconds', 'gauge', 'seconds', "When byop last finished a command", time.time(), command=command)
+    add('byop_duration_seconds', 'gauge', 'seconds', "Duration of the byop command", this.root_span.duration(), command=command)
+
+    sections = collections.OrderedDict()
+    for section, patch, span in this.patch_spans:
+        if span.parent:
+            sections[section.name] = span.parent
+        duration = span.duration()
+        add('byop_patch_duration_seconds', 'gauge', 'seconds', "Time from queueing a patch until it is in cpu_archives", duration, product=section.name, patch=patch.number)
+        add('byop_patch_download_bytes', 'gauge', 'bytes', "Bytes downloaded from MOS for a patch", totals.get(span.id, 0), product=section.name, patch=patch.number)
+    for product, span in sections.items():
+        duration = span.duration()
+        add('byop_product_duration_seconds', 'gauge', 'seconds', "Time to download and process all patches for a product", duration, product=product)
+        add('byop_product_download_bytes', 'gauge', 'bytes', "Bytes downloaded from MOS for a product", totals.get(span.id, 0), product=product)
+        add('byop_product_throughput_bytes_per_second', 'gauge', 'bytes_per_second', "Download throughput for a product",
+            totals.get(span.id, 0) / duration if duration > 0 else 0, product=product)
+    if this.patch_spans:
+        downloaded = sum(totals.get(span.id, 0) for section, patch, span in this.patch_spans)
+        add('byop_download_bytes', 'gauge', 'bytes', "Bytes downloaded from MOS", downloaded)
+        add('byop_digest_reread_bytes', 'gauge', 'bytes', "Downloaded bytes read back from disk to checksum them", this.counters['digest_reread_bytes'])
+
+    for name, help in (('search_cache_hits', "MOS searches answered from the search cache"),
+                       ('search_cache_misses', "MOS searches sent to MOS"),
+                       ('patch_status_hits', "Patches skipped because they were already downloaded"),
+                       ('patch_store_hits', "Files taken from the shared patch store instead of MOS"),
+                       ('download_resumes', "Downloads resumed from a .part file"),
+                       ('download_retries', "Download requests retried after an error"),
+                       ('download_failures', "Downloads that failed and were left for the next run")):
+        if this.patch_spans or this.counters[name]:
+            add('byop_' + name, 'gauge', None, help, this.counters[name])
+
+    for archive in this.archives:
+        if os.path.exists(archive):
+            add('byop_archive_size_bytes', 'gauge', 'bytes', "Size of each PT-INFRA zip file", os.path.getsize(archive), archive=os.path.basename(archive))
+
+    lines = []
+    for name, (kind, unit, help, samples) in families.items():
+        lines.append('# TYPE ' + name + ' ' + kind)
+        if unit:
+            lines.append('# UNIT ' + name + ' ' + unit)
+        lines.append('# HELP ' + name + ' ' + help)
+        for sample_labels, value in samples:
+            text = ','.join(key + '="' + __escape_label(value) + '"' for key, value in sorted(sample_labels.items()))
+            lines.append(name + ('{' + text + '}' if text else '') + ' ' + __format_metric(value))
+    lines.append('# EOF')
+
+    try:
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+        logging.debug("Metrics written to " + path)
+    except OSError as e:
+        logging.warning("Could not write metrics file " + path + ": " + str(e))
+
+def __escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def __format_metric(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(round(float(value), 6))
+
+# Profiling
+def run_profiled(path, memory, command, args, kwargs):
+    # cProfile only sees the thread it runs on, so every thread started during the
+    # command gets its own profiler and they are merged at the end
+    this.profilers = []
+    sampler = __start_memory_sampler() if memory else None
+    profiler = cProfile.Profile()
+    threading.setprofile(__profile_thread)
+    profiler.enable()
+    try:
+        return command(*args, **kwargs)
+    finally:
+        profiler.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profiler)
+        with this.profile_lock:
+            for thread_profiler in this.profilers:
+                stats.add(thread_profiler)
+        __save_profile(stats, path, kwargs.get('quiet'))
+        if sampler:
+            __save_memory_snapshot(sampler, path + '.memory', kwargs.get('quiet'))
+
+def __profile_thread(frame, event, arg):
+    # first event in a new thread - hand the thread over to its own profiler
+    sys.setprofile(None)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one profiler, and it already sees every thread
+        return
+    with this.profile_lock:
+        this.profilers.append(profiler)
+
+def __save_profile(stats, path, quiet):
+    try:
+        stats.dump_stats(path)
+        logging.info("Profile written to " + path)
+    except OSError as e:
+        logging.warning("Could not write profile " + path + ": " + str(e))
+    if quiet:
+        return
+
+    top = int(this.config.get('profile_top') or 20)
+    header = "---------------------------------------"
+    print(header)
+    print("Top " + str(top) + " functions by own time, all threads")
+    print(header)
+    stats.strip_dirs().sort_stats('tottime').print_stats(top)
+
+def __start_memory_sampler():
+    # tracemalloc has no snapshot at the peak, so keep the snapshot of the largest heap seen
+    sampler = {'snapshot': None, 'size': 0, 'stop': threading.Event()}
+    tracemalloc.start()
+    def sample():
+        while not sampler['stop'].wait(PROFILE_MEMORY_INTERVAL):
+            __sample_memory(sampler)
+    sampler['thread'] = threading.Thread(target=sample, name='profile-memory', daemon=True)
+    sampler['thread'].start()
+    return sampler
+
+def __sample_memory(sampler):
+    current, peak = tracemalloc.get_traced_memory()
+    if current > sampler['size'] or sampler['snapshot'] is None:
+        sampler['snapshot'] = tracemalloc.take_snapshot()
+        sampler['size'] = current
+
+def __save_memory_snapshot(sampler, path, quiet):
+    sampler['stop'].set()
+    sampler['thread'].join()
+    __sample_memory(sampler)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    snapshot = sampler['snapshot'].filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    try:
+        snapshot.dump(path)
+        logging.info("Memory snapshot written to " + path)
+    except OSError as e:
+        logging.warning("Could not write memory snapshot " + path + ": " + str(e))
+    if quiet:
+        return
+
+    header = "---------------------------------------"
+    print("Peak traced memory: {:.1f} MB (snapshot at {:.1f} MB)".format(peak / 1024 / 1024, sampler['size'] / 1024 / 1024))
+    print(header)
+    for stat in snapshot.statistics('lineno')[:10]:
+        print("{:>9.1f} KB  ".format(stat.size / 1024) + str(stat.traceback))
+    print(header)
 
 def error_timings(name):
     end_timing(name)
@@ -1044,6 +3317,7 @@ def print_timings():
         for key, value in this.timings.items():
             logging.debug(key + ": " + str(value) )
 
+        spans, totals = __span_totals()
         header = "---------------------------------------"
         print(header)
         for name in this.timings:
@@ -1053,14 +3327,18 @@ def print_timings():
                 duration = this.timings[name]
                 hours, remainder = divmod(duration.total_seconds(), 3600)
                 minutes, seconds = divmod(remainder, 60)
-                print( '{:29}'.format(name) + ": {:02.0f}:{:02.0f}:{:02.0f}".format(hours, minutes, seconds) )
+                line = '{:29}'.format(name) + ": {:02.0f}:{:02.0f}:{:04.1f}".format(hours, minutes, seconds)
+                span = this.timing_spans.get(name)
+                if span and totals.get(span.id):
+                    line += __format_bytes(totals[span.id], duration.total_seconds())
+                print(line)
 
         print(header)
 
         duration = this.timings[this.total_time_key]
         hours, remainder = divmod(duration.total_seconds(), 3600)
         minutes, seconds = divmod(remainder, 60)
-        print( '{:29}'.format(this.total_time_key) + ": {:02.0f}:{:02.0f}:{:02.0f}".format(hours, minutes, seconds) )
+        print( '{:29}'.format(this.total_time_key) + ": {:02.0f}:{:02.0f}:{:04.1f}".format(hours, minutes, seconds) )
 
         print(header)
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# byop is a single module at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
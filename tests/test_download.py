@@ -0,0 +1,112 @@
+"""Segment planning, resumable .part sidecars and checksum verification for downloads."""
+import hashlib
+import os
+
+import pytest
+
+import byop
+
+plan_segments = getattr(byop, '__plan_segments')
+create_part = getattr(byop, '__create_part')
+load_part = getattr(byop, '__load_part')
+save_part = getattr(byop, '__save_part')
+verify_download = getattr(byop, '__verify_download')
+
+MB = 1024 * 1024
+
+
+class Response(object):
+    def __init__(self, status_code=206, **headers):
+        self.status_code = status_code
+        self.headers = {name.replace('_', '-'): value for name, value in headers.items()}
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    config = byop.Config({'download_segments': 4, 'segment_min_size': MB, byop.TEMP: str(tmp_path)})
+    monkeypatch.setattr(byop.this, 'config', config)
+    return config
+
+
+def test_segments_cover_the_file(config):
+    length = 10 * MB + 3
+    segments = plan_segments(Response(), length)
+    assert len(segments) == 4
+    assert segments[0][0] == 0 and segments[-1][1] == length - 1
+    for (start, end), (next_start, next_end) in zip(segments, segments[1:]):
+        assert next_start == end + 1
+
+
+@pytest.mark.parametrize('response, length', [
+    (Response(), MB - 1),
+    (Response(200), 10 * MB),
+    (Response(200, Accept_Ranges='none'), 10 * MB),
+])
+def test_single_stream(config, response, length):
+    assert plan_segments(response, length) == []
+
+
+def test_accept_ranges_on_a_full_response(config):
+    assert len(plan_segments(Response(200, Accept_Ranges='bytes'), 10 * MB)) == 4
+
+
+def test_single_segment_setting(config):
+    config['download_segments'] = 1
+    assert plan_segments(Response(), 10 * MB) == []
+
+
+def test_part_round_trip(config, tmp_path):
+    path = str(tmp_path / 'p1.zip')
+    r = Response(ETag='"abc"')
+    part = create_part(path, 'https://mos/p1?patch_file=p1.zip', r, 4 * MB, plan_segments(r, 4 * MB))
+    assert os.path.getsize(path + '.part') == 4 * MB
+
+    part['segments'][1][2] = 12345
+    save_part(path, part)
+    assert load_part(path, r, 4 * MB) == part
+    assert not os.path.exists(path + '.part.json.tmp')
+
+
+@pytest.mark.parametrize('response, length', [
+    (Response(ETag='"def"'), 4 * MB),
+    (Response(ETag='"abc"'), 4 * MB + 1),
+    (Response(200, ETag='"abc"'), 4 * MB),
+])
+def test_part_mismatch_starts_over(config, tmp_path, response, length):
+    path = str(tmp_path / 'p1.zip')
+    r = Response(ETag='"abc"')
+    create_part(path, 'https://mos/p1?patch_file=p1.zip', r, 4 * MB, plan_segments(r, 4 * MB))
+    assert load_part(path, response, length) is None
+
+
+def test_unreadable_sidecar(config, tmp_path):
+    path = str(tmp_path / 'p1.zip')
+    r = Response(ETag='"abc"')
+    create_part(path, 'https://mos/p1?patch_file=p1.zip', r, MB, [])
+    with open(path + '.part.json', 'w') as f:
+        f.write('{"url": ')
+    assert load_part(path, r, MB) is None
+
+
+def test_bad_digest_removes_the_download(config, tmp_path, monkeypatch):
+    path = tmp_path / 'p1.zip'
+    path.write_bytes(b'not the patch')
+    digests = {'sha256': hashlib.sha256(b'not the patch').hexdigest(), 'md5': hashlib.md5(b'not the patch').hexdigest()}
+    monkeypatch.setattr(byop.this, 'mos_digests', {'p1.zip': {'sha256': hashlib.sha256(b'the patch').hexdigest()}})
+    monkeypatch.setattr(byop.this, 'file_digests', {})
+
+    assert verify_download('p1.zip', str(path), digests) is False
+    assert not path.exists()
+    assert 'p1.zip' not in byop.this.file_digests
+
+
+def test_good_digest(config, tmp_path, monkeypatch):
+    path = tmp_path / 'p1.zip'
+    path.write_bytes(b'the patch')
+    digests = {'sha256': hashlib.sha256(b'the patch').hexdigest(), 'md5': hashlib.md5(b'the patch').hexdigest()}
+    monkeypatch.setattr(byop.this, 'mos_digests', {'p1.zip': {'sha256': digests['sha256']}})
+    monkeypatch.setattr(byop.this, 'file_digests', {})
+
+    assert verify_download('p1.zip', str(path), digests) is True
+    assert path.exists()
+    assert byop.this.file_digests['p1.zip']['verified'] is True
@@ -0,0 +1,56 @@
+"""ParallelGzipWriter output must be one standard gzip member, whatever the block boundaries."""
+import io
+import os
+import gzip
+import shutil
+import subprocess
+
+import pytest
+
+import byop
+
+BLOCK = byop.ParallelGzipWriter.BLOCK_SIZE
+SIZES = [0, 1, BLOCK - 1, BLOCK, BLOCK + 1, 2 * BLOCK, 5 * BLOCK + 17]
+
+
+def sample(size):
+    # repeats across block boundaries exercise the dictionary, random runs don't compress at all
+    text = b'PeopleTools Infra-DPK ' * 200
+    data = bytearray()
+    while len(data) < size:
+        data += text + os.urandom(512)
+    return bytes(data[:size])
+
+
+def compress(data, threads, level=6, chunk=10000):
+    out = io.BytesIO()
+    with byop.ParallelGzipWriter(out, level, threads) as gz:
+        for start in range(0, len(data), chunk):
+            gz.write(data[start:start + chunk])
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('threads', [1, 4])
+def test_round_trip(size, threads):
+    data = sample(size)
+    assert gzip.decompress(compress(data, threads)) == data
+
+
+@pytest.mark.parametrize('level', [1, 9])
+def test_levels(level):
+    data = sample(3 * BLOCK)
+    assert gzip.decompress(compress(data, 2, level)) == data
+
+
+def test_whole_block_writes():
+    data = sample(3 * BLOCK)
+    assert gzip.decompress(compress(data, 2, chunk=BLOCK)) == data
+
+
+@pytest.mark.skipif(not shutil.which('gzip'), reason='gzip is not installed')
+@pytest.mark.parametrize('size', SIZES)
+def test_gzip_accepts_output(tmp_path, size):
+    path = tmp_path / 'sample.gz'
+    path.write_bytes(compress(sample(size), 4))
+    subprocess.check_call(['gzip', '-t', str(path)])
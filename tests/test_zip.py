@@ -0,0 +1,151 @@
+"""Refreshing a zip volume in place, as byop zip and the build packager do."""
+import os
+import queue
+import zipfile
+import warnings
+
+import pytest
+
+import byop
+
+zipvolume = getattr(byop, '__zipvolume')
+run_packager = getattr(byop, '__run_packager')
+
+
+@pytest.fixture
+def archive(tmp_path):
+    folder = tmp_path / 'cpu_archives' / 'weblogic_patches'
+    folder.mkdir(parents=True)
+    entries = [('cpu_archives/weblogic_patches/', str(folder))]
+    for name, size in (('a.zip', 1000), ('b.zip', 2000), ('c.zip', 3000)):
+        path = folder / name
+        path.write_bytes(os.urandom(size))
+        entries.append(('cpu_archives/weblogic_patches/' + name, str(path)))
+    return tmp_path, entries
+
+
+def contents(zip_path):
+    with zipfile.ZipFile(str(zip_path)) as zip:
+        assert zip.testzip() is None
+        return [(info.filename, zip.read(info)) for info in zip.infolist()]
+
+
+def expected(entries):
+    return [(arcname, b'' if arcname.endswith('/') else open(path, 'rb').read()) for arcname, path in entries]
+
+
+def test_create(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries)
+    assert contents(zip_path) == expected(entries)
+
+
+def test_up_to_date_volume_is_not_rewritten(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries)
+    before = os.stat(str(zip_path))
+    zipvolume(str(zip_path), entries)
+    after = os.stat(str(zip_path))
+    assert (before.st_ino, before.st_mtime_ns, before.st_size) == (after.st_ino, after.st_mtime_ns, after.st_size)
+
+
+def test_changed_member(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries)
+    with open(entries[2][1], 'wb') as f:
+        f.write(os.urandom(2500))
+    zipvolume(str(zip_path), entries)
+    assert contents(zip_path) == expected(entries)
+    assert not os.path.exists(str(zip_path) + '.tmp')
+
+
+def test_append(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries)
+    path = tmp_path / 'cpu_archives' / 'weblogic_patches' / 'd.zip'
+    path.write_bytes(os.urandom(4000))
+    entries.append(('cpu_archives/weblogic_patches/d.zip', str(path)))
+    zipvolume(str(zip_path), entries)
+    assert contents(zip_path) == expected(entries)
+
+
+def test_duplicate_member_refresh(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    # an older byop appended a second copy of a member instead of replacing it
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with zipfile.ZipFile(str(zip_path), 'w') as zip:
+            for arcname, path in entries:
+                zip.write(path, arcname)
+            zip.write(entries[1][1], entries[1][0])
+    zipvolume(str(zip_path), entries)
+    assert contents(zip_path) == expected(entries)
+
+
+def test_stale_tail_is_cut_off_in_place(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries)
+    with zipfile.ZipFile(str(zip_path)) as zip:
+        cut = zip.getinfo(entries[3][0]).header_offset
+    before = os.stat(str(zip_path))
+    head = zip_path.read_bytes()[:cut]
+
+    with open(entries[3][1], 'wb') as f:
+        f.write(os.urandom(2500))
+    zipvolume(str(zip_path), entries)
+    assert contents(zip_path) == expected(entries)
+    # same file, and the members before the stale one were not written again
+    assert os.stat(str(zip_path)).st_ino == before.st_ino
+    assert zip_path.read_bytes()[:cut] == head
+
+
+def test_failed_rebuild_keeps_the_old_volume(archive):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    with zipfile.ZipFile(str(zip_path), 'w') as zip:
+        zip.writestr('old.txt', b'old')
+    old = zip_path.read_bytes()
+
+    entries.append(('cpu_archives/weblogic_patches/missing.zip', str(tmp_path / 'missing.zip')))
+    with pytest.raises(OSError):
+        zipvolume(str(zip_path), entries)
+    assert zip_path.read_bytes() == old
+    assert not os.path.exists(str(zip_path) + '.tmp')
+
+
+def package(monkeypatch, tmp_path, zip_path, entries):
+    monkeypatch.setattr(byop.this, 'config', {byop.ARCHIVE: str(tmp_path / 'cpu_archives')})
+    packager = {'zip_paths': [str(zip_path)], 'queue': queue.Queue(), 'error': None}
+    for arcname, path in entries:
+        if not arcname.endswith('/'):
+            packager['queue'].put((arcname, path))
+    packager['queue'].put(None)
+    run_packager(packager)
+    assert packager['error'] is None
+
+
+def test_packager_leaves_current_volume_alone(archive, monkeypatch):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries + [('psft_patches.yaml', entries[1][1])])
+    before = os.stat(str(zip_path))
+    package(monkeypatch, tmp_path, zip_path, entries)
+    after = os.stat(str(zip_path))
+    assert (before.st_ino, before.st_mtime_ns, before.st_size) == (after.st_ino, after.st_mtime_ns, after.st_size)
+
+
+def test_packager_opens_volume_for_new_file(archive, monkeypatch):
+    tmp_path, entries = archive
+    zip_path = tmp_path / 'volume.zip'
+    zipvolume(str(zip_path), entries + [('psft_patches.yaml', entries[1][1])])
+    path = tmp_path / 'cpu_archives' / 'weblogic_patches' / 'd.zip'
+    path.write_bytes(os.urandom(4000))
+    entries.append(('cpu_archives/weblogic_patches/d.zip', str(path)))
+    package(monkeypatch, tmp_path, zip_path, entries)
+    assert contents(zip_path) == expected(entries)